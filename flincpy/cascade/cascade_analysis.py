@@ -8,9 +8,11 @@ from cascade_driver import CascadeDriver
 from pympler import asizeof
 import particle
 from pdg_pid_map import PdgLists
+from particle_memmap import MemmapParticleArray
 
 
 from copy import copy
+from pathlib import Path
 
 
 class CascadeAnalysis:
@@ -29,6 +31,20 @@ class CascadeAnalysis:
         self.pack_data()
 
 
+    def load_history(self, history_path):
+        """Use archival and generated stacks written to `history_path` 
+        by CascadeDriver(history_path=...) 
+        
+        Stacks are memory mapped, only the accessed parts are read. 
+        They are opened in copy-on-write mode, so analysis doesn't change the files.
+        """
+        history_path = Path(history_path)
+        self.cascade_driver.archival_stack = MemmapParticleArray.open(
+            history_path / "archival_stack.dat", mode="c")
+        self.cascade_driver.generated_stack = MemmapParticleArray.open(
+            history_path / "generated_stack.dat", mode="c")
+
+
     def check_ids(self):        
         values, counts = np.unique(self.final_particles.id, return_counts=True)
         
@@ -64,6 +80,8 @@ class CascadeAnalysis:
             exec_time = self.cascade_driver.loop_execution_time/self.cascade_driver.runs_number
             print(f"  Exectution time per run = {exec_time:.2f} s")
         print(f"  Size of cascade_driver object = {asizeof.asizeof(self.cascade_driver)/(1024**2):.2f} Mb")
+        pool_stats = self.cascade_driver.particle_pool.stats()
+        print(f"  Particle pool hits = {pool_stats['hits']}, misses = {pool_stats['misses']}")
         self.energy_conservation()
         self.check_ids()
     
@@ -149,7 +167,7 @@ class CascadeAnalysis:
                          
     
     def energy_conservation(self):     
-        etot = np.sum(self.energy_data)/self.cascade_driver.runs_number
+        etot = np.sum(self.energy_data * self.weight_data)/self.cascade_driver.runs_number
         init_energy = self.cascade_driver.initial_energy
         conservation = (init_energy - etot)/init_energy
         
@@ -173,6 +191,11 @@ class CascadeAnalysis:
         self.energy_data = self.final_particles.energy
         self.xdepth_data = self.final_particles.xdepth
         self.xdepth_stop = self.final_particles.xdepth_stop
+        # Weights of thinned particles, 1 without thinning
+        if "weight" in self.final_particles.data_attributes:
+            self.weight_data = self.final_particles.weight
+        else:
+            self.weight_data = np.ones(len(self.final_particles))
         self.height_data = self.cascade_driver.xdepth_getter.xdepth_on_table.convert_x2h(self.final_particles.xdepth)
         self.height_data = self.height_data * 1e-5
         
@@ -195,10 +218,12 @@ class CascadeAnalysis:
         for pid in self.all_pids:            
             en_vec = self.energy_data[np.where(self.pid_data == pid)[0]]
             xd_vec = self.xdepth_data[np.where(self.pid_data == pid)[0]]
+            w_vec = self.weight_data[np.where(self.pid_data == pid)[0]]
             
             
             npart = np.histogram2d(xd_vec, en_vec, 
-                           bins=(xdepth_grid_bins, energy_grid_bins))
+                           bins=(xdepth_grid_bins, energy_grid_bins),
+                           weights=w_vec)
             
             hist_dict[pid] = npart
         
@@ -211,8 +236,8 @@ class CascadeAnalysis:
 
         pid_dist = dict()
 
-        for pid in self.final_particles.pid:
-            pid_dist[pid] = pid_dist.get(pid, 0) + 1
+        for i, pid in enumerate(self.final_particles.pid):
+            pid_dist[pid] = pid_dist.get(pid, 0) + self.weight_data[i]
 
         pid_dist = dict(
             sorted(pid_dist.items(), key=lambda item: item[1], reverse=True)
@@ -237,8 +262,8 @@ class CascadeAnalysis:
         en_dist = dict()
 
         for i, pid in enumerate(self.final_particles.pid):
-            pid_dist[pid] = pid_dist.get(pid, 0) + 1
-            en_dist[pid] = en_dist.get(pid, 0) + self.final_particles.energy[i]
+            pid_dist[pid] = pid_dist.get(pid, 0) + self.weight_data[i]
+            en_dist[pid] = en_dist.get(pid, 0) + self.final_particles.energy[i] * self.weight_data[i]
             
         # print(np.sum(self.final_particles.energy))    
 
@@ -329,14 +354,13 @@ class CascadeAnalysis:
     def plot_energy_list(self, pids=None, all_pids = None, nbins = 100, xrange = None):
         
         energy_data = []
+        weight_data = []
 
         if pids:
             for pid in pids:
-                energy_data_pid = []
-                for i, ppid in enumerate(self.pid_data):
-                    if ppid == pid:
-                        energy_data_pid.append(self.energy_data[i])
-                energy_data.append(energy_data_pid)        
+                of_pid = np.where(self.pid_data == pid)[0]
+                energy_data.append(self.energy_data[of_pid])
+                weight_data.append(self.weight_data[of_pid])
             
         if xrange:
             xrange = (np.log10(xrange[0]*1e-9), np.log10(xrange[1]*1e-9))
@@ -347,12 +371,14 @@ class CascadeAnalysis:
         plt.semilogx()
             
         for i, pid in enumerate(pids):
-            gr, cnt = np.histogram(np.log10(energy_data[i]), bins = nbins, range = xrange)
+            gr, cnt = np.histogram(np.log10(energy_data[i]), bins = nbins, range = xrange,
+                                   weights = weight_data[i])
             plt.semilogx()
             plt.step(10 ** cnt[:-1] * 1e9, gr, label = f"{self.all_pdgs[pid]}")
             
         if all_pids:
-            gr, cnt = np.histogram(np.log10(self.energy_data), bins = nbins, range = xrange)
+            gr, cnt = np.histogram(np.log10(self.energy_data), bins = nbins, range = xrange,
+                                   weights = self.weight_data)
             plt.semilogx()
             plt.step(10 ** cnt[:-1] * 1e9, gr, label = f"all")
                 
@@ -368,8 +394,10 @@ class CascadeAnalysis:
         for pdg in pdgs:
             mass = self.all_pdgs_mass[pdg]
             print(f"Histogram of {pdg} with mass {mass}")
-            energies_of_pdg = final_stack.energy[np.where(final_stack.pid == pdg)[0]] - mass
-            hist, bin_edges = np.histogram(energies_of_pdg, bins = bins)
+            of_pdg = np.where(final_stack.pid == pdg)[0]
+            energies_of_pdg = final_stack.energy[of_pdg] - mass
+            weights = final_stack.weight[of_pdg] if "weight" in final_stack.data_attributes else None
+            hist, bin_edges = np.histogram(energies_of_pdg, bins = bins, weights = weights)
             
             if hist_values is None:
                 hist_values = hist
@@ -504,23 +532,30 @@ class CascadeAnalysis:
         
         height_data_e = []
         pid_data_e = []
+        weight_data_e = []
              
         if energy_range:
             for i, hh in enumerate(self.height_data):
                 if energy_range[0] <= self.energy_data[i] <= energy_range[1]:
                     height_data_e.append(hh)
                     pid_data_e.append(self.pid_data[i])
+                    weight_data_e.append(self.weight_data[i])
         else:
             height_data_e = self.height_data
             pid_data_e = self.pid_data
+            weight_data_e = self.weight_data
             
+        weight_data = []
         if pids:
             for pid in pids:
                 height_data_pid = []
+                weight_data_pid = []
                 for i, ppid in enumerate(pid_data_e):
                     if ppid == pid:
                         height_data_pid.append(height_data_e[i])
+                        weight_data_pid.append(weight_data_e[i])
                 height_data.append(height_data_pid)
+                weight_data.append(weight_data_pid)
         
         
         height_data_tot = height_data_e                     
@@ -529,11 +564,13 @@ class CascadeAnalysis:
         plt.xlabel("Height, km") 
             
         for i, pid in enumerate(pids):
-            gr, cnt = np.histogram(height_data[i], bins = nbins, range = xrange)
+            gr, cnt = np.histogram(height_data[i], bins = nbins, range = xrange,
+                                   weights = weight_data[i])
             plt.step(cnt[:-1], gr, label = f"{self.all_pdgs[pid]}")
             
         if all_pids:
-            gr, cnt = np.histogram(height_data_tot, bins = nbins, range = xrange)
+            gr, cnt = np.histogram(height_data_tot, bins = nbins, range = xrange,
+                                   weights = weight_data_e)
             plt.step(cnt[:-1], gr, label = f"all")
                 
             
@@ -561,23 +598,30 @@ class CascadeAnalysis:
         
         xdepth_data_e = []
         pid_data_e = []
+        weight_data_e = []
              
         if energy_range:
             for i, hh in enumerate(self.xdepth_data):
                 if energy_range[0] <= self.energy_data[i] <= energy_range[1]:
                     xdepth_data_e.append(hh)
                     pid_data_e.append(self.pid_data[i])
+                    weight_data_e.append(self.weight_data[i])
         else:
             xdepth_data_e = self.xdepth_data
             pid_data_e = self.pid_data
+            weight_data_e = self.weight_data
             
+        weight_data = []
         if pids:
             for pid in pids:
                 xdepth_data_pid = []
+                weight_data_pid = []
                 for i, ppid in enumerate(pid_data_e):
                     if ppid == pid:
                         xdepth_data_pid.append(xdepth_data_e[i])
+                        weight_data_pid.append(weight_data_e[i])
                 xdepth_data.append(xdepth_data_pid)
+                weight_data.append(weight_data_pid)
         
         
         xdepth_data_tot = xdepth_data_e                    
@@ -594,13 +638,15 @@ class CascadeAnalysis:
         
         if pids:    
             for i, pid in enumerate(pids):
-                gr, cnt = np.histogram(xdepth_data[i], bins = nbins, range = xrange)
+                gr, cnt = np.histogram(xdepth_data[i], bins = nbins, range = xrange,
+                                       weights = weight_data[i])
                 grsum = np.cumsum(gr)
                 plt.step(cnt[:-1], gr/runs_number, label = f"{self.all_pdgs[pid]}")
                 # plt.step(cnt[:-1], grsum/runs_number, label = f"cumul_{self.all_pdgs[pid]}")
             
         if all_pids:
-            gr, cnt = np.histogram(xdepth_data_tot, bins = nbins, range = xrange)
+            gr, cnt = np.histogram(xdepth_data_tot, bins = nbins, range = xrange,
+                                   weights = weight_data_e)
             grsum = np.cumsum(gr)
             plt.step(cnt[:-1], gr/runs_number, label = f"all")
             # plt.step(cnt[:-1], grsum/runs_number, label = f"cumul_all")
@@ -631,23 +677,30 @@ class CascadeAnalysis:
         
         xdepth_data_e = []
         pid_data_e = []
+        weight_data_e = []
              
         if energy_range:
             for i, hh in enumerate(self.xdepth_stop):
                 if energy_range[0] <= self.energy_data[i] <= energy_range[1]:
                     xdepth_data_e.append(hh)
                     pid_data_e.append(self.pid_data[i])
+                    weight_data_e.append(self.weight_data[i])
         else:
             xdepth_data_e = self.xdepth_stop
             pid_data_e = self.pid_data
+            weight_data_e = self.weight_data
             
+        weight_data = []
         if pids:
             for pid in pids:
                 xdepth_data_pid = []
+                weight_data_pid = []
                 for i, ppid in enumerate(pid_data_e):
                     if ppid == pid:
                         xdepth_data_pid.append(xdepth_data_e[i])
+                        weight_data_pid.append(weight_data_e[i])
                 xdepth_data.append(xdepth_data_pid)
+                weight_data.append(weight_data_pid)
         
         
         xdepth_data_tot = xdepth_data_e                    
@@ -664,13 +717,15 @@ class CascadeAnalysis:
         
         if pids:    
             for i, pid in enumerate(pids):
-                gr, cnt = np.histogram(xdepth_data[i], bins = nbins, range = xrange)
+                gr, cnt = np.histogram(xdepth_data[i], bins = nbins, range = xrange,
+                                       weights = weight_data[i])
                 grsum = np.cumsum(gr)
                 plt.step(cnt[:-1], gr/runs_number, label = f"{self.all_pdgs[pid]}")
                 # plt.step(cnt[:-1], grsum/runs_number, label = f"cumul_{self.all_pdgs[pid]}")
             
         if all_pids:
-            gr, cnt = np.histogram(xdepth_data_tot, bins = nbins, range = xrange)
+            gr, cnt = np.histogram(xdepth_data_tot, bins = nbins, range = xrange,
+                                   weights = weight_data_e)
             grsum = np.cumsum(gr)
             plt.step(cnt[:-1], gr/runs_number, label = f"all")
             # plt.step(cnt[:-1], grsum/runs_number, label = f"cumul_all")
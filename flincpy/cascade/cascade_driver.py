@@ -3,35 +3,200 @@ import numpy as np
 from data_structs.particle_array import ParticleArray
 from data_structs.pdg_pid_map import PdgLists
 from data_structs.id_generator import IdGenerator
+from data_structs.particle_pool import ParticleArrayPool
+from data_structs.particle_memmap import MemmapParticleArray
+from data_structs import particle_kernels
+from data_structs.stage_timer import StageTimer
 
 from propagation.particle_xdepths import DefaultXdepthGetter
 
 from process.hadron_inter import HadronInteraction
+from process.yield_library import TabulatedHadronInteraction
+from process.hadron_pool import HadronInteractionPool
+from process.hybrid_hadron_inter import HybridHadronInteraction
 from process.decay_driver import DecayDriver
+from process.thinning import HillasThinning
 import numpy as np
+import json
 import time
+from pathlib import Path
 
 
 class CascadeDriver:
-    def __init__(self, zenith_angle):
-        
+    # Columns of ParticleArray used by the driver itself
+    required_columns = ["pid",
+                        "energy",
+                        "xdepth",
+                        "xdepth_stop",
+                        "generation_num",
+                        "xdepth_decay",
+                        "xdepth_inter",
+                        "production_code",
+                        "final_code",
+                        "id"]
+    
+    # Columns of generated stack for history = "parents"
+    parent_link_columns = ["pid",
+                           "id",
+                           "parent_id"]
+    
+    history_levels = ["none", "parents", "full"]
+    
+    def __init__(self, zenith_angle, lean = False, output_columns = None, 
+                 compact_history = False, history_path = None, seed = None,
+                 sink = None, history = "full", timing = True,
+                 particle_budget = None, yield_library = None,
+                 yield_library_max_energy = None, hadron_workers = None,
+                 hadron_models = None):
+        """
+        Args:
+            zenith_angle (float): zenith angle in degrees
+            lean (bool): if True, working stacks have only the columns 
+                required by the driver, xdepth getters, hadron interaction
+                and decay driver, and output stacks (final, archival, generated) 
+                have `ParticleArray.lean_attributes` columns
+            output_columns (list): columns of output stacks, 
+                overrides the default of `lean`
+            compact_history (bool): if True, archival and generated stacks
+                are stored in compact precision (see ParticleArray)
+            history_path (str or Path): if given, archival and generated stacks
+                are kept on disk in this directory (see MemmapParticleArray)
+                and can be opened later with `MemmapParticleArray.open`
+            seed (int or np.random.SeedSequence): root of all random streams,
+                random if None. The entropy is in `seed_sequence.entropy`. 
+                Event generators are seeded once from child sequences, 
+                xdepth sampling gets a new child stream at every run
+            sink (callable): called as `sink(cascade_driver)` after every run 
+                (see `set_sink`)
+            history (str): which history is recorded:
+                "full" - all generated particles in generated stack and
+                    all particles which interacted or decayed in archival stack,
+                "parents" - only pid, id and parent_id of generated particles 
+                    in generated stack, archival stack is not filled,
+                "none" - no history, both stacks stay empty
+            timing (bool): collect per stage timing, see `performance_report`
+            particle_budget (int): if given, at most `particle_budget` particles
+                are processed in one iteration. The rest wait in `pending_stack`,
+                which is processed depth-first (the latest produced particles 
+                first), and decays run as soon as `decay_stack` exceeds the budget.
+                It bounds the peak memory by the shower depth instead of 
+                the widest generation, the physics is the same
+            yield_library (str or Path): if given, hadron interactions below 
+                `yield_library_max_energy` are sampled from this library 
+                (see `build_yield_library`), the rest run DPMJET
+            yield_library_max_energy (float): maximal energy of sampled 
+                interactions, the end of library energy grid if None
+            hadron_workers (int): if given, hadron interactions run in 
+                this number of worker processes (see HadronInteractionPool)
+            hadron_models (list): if given, interaction model is chosen 
+                by projectile and energy bands (see HybridHadronInteraction),
+                e.g. [("DpmjetIII191", None, 1e3), ("Sibyll23d", 1e3, None)]
+        """
+        if history not in self.history_levels:
+            raise ValueError(f"history should be one of {self.history_levels}, "
+                             f"got {history}")
+        self.history = history
+        if hadron_workers is not None and hadron_models is not None:
+            raise ValueError("hadron_workers and hadron_models can't be used together")
+        
+        self.seed_sequence = seed
+        if not isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = np.random.SeedSequence(seed)
+        decay_seed, hadron_seed, self.run_seeds, self.resume_seeds = self.seed_sequence.spawn(4)
+        
+        self.timer = StageTimer(enabled=timing)
         self.id_generator = IdGenerator()
         self.xdepth_getter = DefaultXdepthGetter(zenith_angle)
-        self.hadron_interaction = HadronInteraction()
-        self.decay_driver = DecayDriver(self.xdepth_getter)
-        
-        
-        self.final_stack_decay = ParticleArray()
-        self.final_stack = ParticleArray()
-        self.archival_stack = ParticleArray()
-        self.generated_stack = ParticleArray()
-        
-        self.working_stack = ParticleArray()
-        self.working_stack_filter = ParticleArray()
-        self.decay_stack = ParticleArray()
-        self.inter_stack = ParticleArray()
-        self.rejection_stack = ParticleArray()
-        self.children_stack = ParticleArray()
+        if hadron_models is not None:
+            self.hadron_interaction = HybridHadronInteraction(hadron_models,
+                                                              seed=hadron_seed,
+                                                              timer=self.timer)
+        elif hadron_workers is None:
+            self.hadron_interaction = HadronInteraction(seed=hadron_seed, timer=self.timer)
+        else:
+            self.hadron_interaction = HadronInteractionPool(nworkers=hadron_workers,
+                                                            seed=hadron_seed, 
+                                                            timer=self.timer)
+        if yield_library is not None:
+            self.hadron_interaction = TabulatedHadronInteraction(
+                yield_library, 
+                max_energy=yield_library_max_energy,
+                fallback=self.hadron_interaction,
+                seed=hadron_seed.spawn(1)[0],
+                timer=self.timer)
+        self.particle_pool = ParticleArrayPool()
+        self.decay_driver = DecayDriver(self.xdepth_getter, 
+                                        particle_pool=self.particle_pool,
+                                        seed=decay_seed,
+                                        timer=self.timer)
+        self.thinning = HillasThinning()
+        self.thinning_level = None
+        
+        self.working_columns = None
+        if lean:
+            self.working_columns = self.get_required_columns()
+            if output_columns is None:
+                output_columns = ParticleArray.lean_attributes
+        self.output_columns = output_columns
+        
+        self.final_stack_decay = ParticleArray(columns=self.working_columns)
+        self.final_stack = ParticleArray(columns=self.output_columns)
+        generated_columns = self.output_columns
+        if history == "parents":
+            generated_columns = self.parent_link_columns
+        
+        self.history_path = history_path
+        if history_path is None or history == "none":
+            self.history_path = None
+            self.archival_stack = ParticleArray(columns=self.output_columns, 
+                                                compact_precision=compact_history)
+            self.generated_stack = ParticleArray(columns=generated_columns, 
+                                                 compact_precision=compact_history)
+        else:
+            self.history_path = Path(history_path)
+            self.history_path.mkdir(parents=True, exist_ok=True)
+            self.archival_stack = MemmapParticleArray(self.history_path / "archival_stack.dat",
+                                                      columns=self.output_columns, 
+                                                      compact_precision=compact_history)
+            self.generated_stack = MemmapParticleArray(self.history_path / "generated_stack.dat",
+                                                       columns=generated_columns, 
+                                                       compact_precision=compact_history)
+        
+        self.working_stack = ParticleArray(columns=self.working_columns)
+        self.working_stack_filter = ParticleArray(columns=self.working_columns)
+        self.decay_stack = ParticleArray(columns=self.working_columns)
+        self.inter_stack = ParticleArray(columns=self.working_columns)
+        self.rejection_stack = ParticleArray(columns=self.working_columns)
+        self.children_stack = ParticleArray(columns=self.working_columns)
+        self.pending_stack = ParticleArray(columns=self.working_columns)
+        self.particle_budget = particle_budget
+        
+        self.set_sink(sink)
+    
+    def set_sink(self, sink):
+        """Set a callable which receives particles of every run
+        
+        After each `run` or `run_many` the driver calls `sink(self)`, 
+        at this point `final_stack`, `archival_stack` and `generated_stack`
+        hold only the particles of this run (`run_showers` showers).
+        The sink can histogram, write or ignore them, then the stacks 
+        are cleared and their memory is reused by the next run. 
+        So the memory is bounded by one run, not by all accumulated runs.
+        Counters (`number_of_interactions`, etc.) are still accumulated.
+        See cascade.particle_sinks for sinks. None switches streaming off.
+        """
+        self.sink = sink
+    
+    def get_required_columns(self):
+        """Union of columns required by the driver and its components
+        """
+        columns = set(self.required_columns)
+        for component in [self.xdepth_getter, 
+                          self.hadron_interaction, 
+                          self.decay_driver,
+                          self.thinning]:
+            columns.update(component.required_columns)
+        return ParticleArray._check_columns(columns)
     
     
         
@@ -43,6 +208,7 @@ class CascadeDriver:
         # Every particle which is not in mceq
         self.force_decaying_pdgs = (pdg_lists.pdgs_below_abs6000[np.where(np.logical_not(
                             np.isin(pdg_lists.pdgs_below_abs6000, pdg_lists.mceq_particles)))[0]])
+        self.force_decaying_table = particle_kernels.PdgTable(self.force_decaying_pdgs)
         
         # Natural decaying pdgs are particles which present in mceq
         # and can be present in final stack
@@ -70,7 +236,20 @@ class CascadeDriver:
                               xdepth = 0,
                               stop_height = 0,
                               accumulate_runs = False,
-                              reset_ids = False):
+                              reset_ids = False,
+                              thinning_level = None,
+                              superposition = False):
+        """
+        Args:
+            thinning_level (float): if given, secondaries below 
+                thinning_level * (energy of primary) are thinned 
+                (see HillasThinning) and carry weights
+            superposition (bool): if True, a nuclear primary (pdg 100ZZZAAAI) 
+                of mass A and energy E is replaced by Z protons and A - Z 
+                neutrons of energy E/A in the initial working stack 
+                (superposition model), instead of nucleus-air interactions 
+                of the event generator. Nucleons have shower_id of the nucleus
+        """
             
         self.initial_pdg = pdg
         self.initial_energy = energy
@@ -86,13 +265,106 @@ class CascadeDriver:
         if reset_ids:
             self.id_generator = IdGenerator()
         
+        self.thinning_level = thinning_level
+        self.superposition = superposition
         self.initial_run = True    
         self.accumulate_runs = accumulate_runs           
     
     def run(self):
         
+        self._start_run(np.array([self.initial_energy], dtype = np.float64))
+        self._push_primaries(self.initial_pdg, self.initial_energy, self.initial_xdepth)
+        self._run_cascade(nshowers = 1)
+    
+    def run_many(self, pdg, energy, xdepth = None):
+        """Simulate several primaries together in one cascade
+        
+        All primaries are pushed into the working stack at once and are 
+        advanced together, so the per-iteration overhead is shared
+        between showers. Each particle carries `shower_id` of its primary,
+        which is `runs_number` at the call plus the index of the primary.
+        Use `split_by_shower` to get particles of the individual showers.
+        
+        Args:
+            pdg (int or array): pdg ids of primaries
+            energy (float or array): energies of primaries
+            xdepth (float or array): starting depths, 
+                `simulation_parameters(xdepth=...)` if None
+        """
+        if xdepth is None:
+            xdepth = self.initial_xdepth
+        pdg, energy, xdepth = np.broadcast_arrays(np.atleast_1d(pdg), 
+                                                  np.atleast_1d(energy), 
+                                                  np.atleast_1d(xdepth))
+        nshowers = len(pdg)
+        
+        self._start_run(energy)
+        self._push_primaries(pdg, energy, xdepth)
+        self._run_cascade(nshowers = nshowers)
+    
+    def _push_primaries(self, pdg, energy, xdepth):
+        """Push primaries into the working stack with shower ids
+        starting from `runs_number`, nuclei are split into nucleons
+        if `superposition` is set
+        """
+        pdg, energy, xdepth = np.broadcast_arrays(np.atleast_1d(pdg), 
+                                                  np.atleast_1d(energy), 
+                                                  np.atleast_1d(xdepth))
+        shower_id = self.runs_number + np.arange(len(pdg))
+        
+        if self.superposition:
+            # Nuclear pdg code 10LZZZAAAI
+            abs_pdg = np.abs(pdg)
+            is_nucleus = abs_pdg >= 1000000000
+            mass = np.where(is_nucleus, (abs_pdg // 10) % 1000, 1)
+            charge = np.where(is_nucleus, (abs_pdg // 10000) % 1000, 0)
+            
+            primary = np.repeat(np.arange(len(pdg)), mass)
+            nucleon = np.arange(len(primary)) - (np.cumsum(mass) - mass)[primary]
+            nucleon_pdg = np.sign(pdg[primary]) * np.where(nucleon < charge[primary], 2212, 2112)
+            
+            pdg = np.where(is_nucleus[primary], nucleon_pdg, pdg[primary])
+            energy = energy[primary] / mass[primary]
+            xdepth = xdepth[primary]
+            shower_id = shower_id[primary]
+        
+        self.working_stack.push(pid = pdg, 
+                         energy = energy, 
+                         xdepth = xdepth,
+                         generation_num = np.zeros(len(pdg), dtype = np.int32),
+                         shower_id = shower_id)
+    
+    def split_by_shower(self, pstack = None):
+        """Split a stack (final stack by default) into per shower views
+        
+        Returns:
+            dict: shower_id -> ParticleArray view with particles of the shower
+        """
+        if pstack is None:
+            pstack = self.final_stack
+        
+        groups = pstack.valid().group_by("shower_id")
+        sorted_stack = ParticleArray(len(pstack), 
+                                     columns = pstack.data_attributes, 
+                                     compact_precision = pstack.compact_precision)
+        sorted_stack.append(pstack[groups.order])
+        
+        showers = {}
+        for shower_id, segment in zip(groups.keys, groups.segments()):
+            showers[int(shower_id)] = sorted_stack[segment]
+        return showers
+    
+    def _start_run(self, primary_energy):
+        
+        # Independent random stream for every run
+        run_seed = self.run_seeds.spawn(1)[0]
+        self.xdepth_getter.set_rng(np.random.default_rng(run_seed))
+        self.thinning.set_rng(run_seed.spawn(1)[0])
+        
         self.working_stack.clear()
         self.decay_stack.clear()
+        self.pending_stack.clear()
+        self.peak_particles = 0
                 
         if self.initial_run:
             self.final_stack.clear()
@@ -101,161 +373,188 @@ class CascadeDriver:
             self.generated_stack.clear()
             self.number_of_decays = 0
             self.number_of_interactions = 0
+            self.number_of_thinned = 0
             self.loop_execution_time = 0
             self.runs_number = 0
+            self.timer.reset()
             
             if self.accumulate_runs:
                 self.initial_run = False  
-            
         
-        self.working_stack.push(pid = self.initial_pdg, 
-                         energy = self.initial_energy, 
-                         xdepth = self.initial_xdepth,
-                         generation_num = 0)
+        # Thinning energy of showers of this run (indexed by shower_id - runs_number)
+        self._first_shower_id = self.runs_number
+        if self.thinning_level is not None:
+            self._thinning_energy = self.thinning_level * np.asarray(primary_energy, dtype = np.float64)
+    
+    def _run_cascade(self, nshowers):
         
         self.id_generator.generate_ids(self.working_stack.valid().id)
-        self.generated_stack.append(self.working_stack)
+        if self.history != "none":
+            self.generated_stack.append(self.working_stack)
         
         iloop = 1
         
         
         start_time = time.time()        
-        while len(self.working_stack) > 0:
+        while len(self.working_stack) > 0 or len(self.pending_stack) > 0:
             
             # print(f"\r{iloop} Number of inter = {self.number_of_interactions}"
             #       f" number of decays = {self.number_of_decays}")
             
-            self.filter_by_energy()
-            self.filter_by_slant_depth()         
-            self.run_hadron_interactions()
-            if len(self.working_stack) == 0:
-                self.run_particle_decay()
+            if self.particle_budget is not None:
+                self.schedule_working_set()
+            
+            timer = self.timer
+            with timer.stage("filter_by_energy", len(self.working_stack)):
+                self.filter_by_energy()
+            with timer.stage("filter_by_slant_depth", len(self.working_stack_filter)):
+                self.filter_by_slant_depth()         
+            with timer.stage("run_hadron_interactions", len(self.inter_stack)):
+                self.run_hadron_interactions()
+            
+            self.peak_particles = max(self.peak_particles, 
+                                      len(self.working_stack) 
+                                      + len(self.pending_stack) 
+                                      + len(self.decay_stack))
+            
+            if self.should_run_decay():
+                # Decay products replace working stack
+                self.pending_stack.append(self.working_stack)
+                with timer.stage("run_particle_decay", len(self.decay_stack)):
+                    self.run_particle_decay()
             
             iloop += 1
         
-        self.run_decay_at_surface()
+        with self.timer.stage("run_decay_at_surface", len(self.final_stack_decay)):
+            self.run_decay_at_surface()
         
         self.loop_execution_time += time.time() - start_time
-        self.runs_number += 1
+        self.runs_number += nshowers
+        self.run_showers = nshowers
+        
+        if self.history_path is not None:
+            self.archival_stack.flush()
+            self.generated_stack.flush()
+        
+        if self.sink is not None:
+            self.sink(self)
+            self.final_stack.clear()
+            self.archival_stack.clear()
+            self.generated_stack.clear()
+    
+    
+    def schedule_working_set(self):
+        """Keep at most `particle_budget` particles in working stack
+        
+        Working stack goes to the end of pending stack, and the last 
+        `particle_budget` particles of pending stack are taken back,
+        so the youngest particles are processed first (depth-first).
+        """
+        budget = self.particle_budget
+        if len(self.working_stack) <= budget and len(self.pending_stack) == 0:
+            return
+        
+        self.pending_stack.append(self.working_stack)
+        self.working_stack.clear()
+        
+        npending = len(self.pending_stack)
+        start = max(0, npending - budget)
+        self.working_stack.append(self.pending_stack[start:npending])
+        self.pending_stack.clear(npending - start)
     
+    def should_run_decay(self):
+        """Decays run when there is nothing left to interact,
+        or, with particle budget, when decay stack exceeds it
+        """
+        if len(self.working_stack) == 0 and len(self.pending_stack) == 0:
+            return True
+        
+        return (self.particle_budget is not None 
+                and len(self.decay_stack) > self.particle_budget)
     
     def filter_by_energy(self):   
         
         wstack = self.working_stack.valid()
         
-        above_threshold = wstack.energy > self.threshold_energy
-        below_threshold =  np.logical_not(above_threshold)
+        # 0: above threshold, 1: final and should decay, 2: final
+        labels = particle_kernels.classify_energy(wstack.energy, wstack.pid,
+                                                  self.threshold_energy,
+                                                  self.force_decaying_table)
         
-        above_threshold = np.where(above_threshold)[0]
         self.working_stack_filter.clear()
-        self.working_stack_filter.append(wstack[above_threshold])
-        
+        counts = wstack.partition(labels, [self.working_stack_filter,
+                                           self.final_stack_decay,
+                                           self.final_stack])
         
-        should_decay = np.isin(wstack.pid, self.force_decaying_pdgs)
-        should_not_decay = np.logical_not(should_decay)
-        
-        should_decay = np.where(np.logical_and(below_threshold, should_decay))[0]
-        should_not_decay = np.where(np.logical_and(below_threshold, should_not_decay))[0]
-
-        self.final_stack_decay.append(wstack[should_decay])
-        self.final_stack.append(wstack[should_not_decay])     
-        
-        
-        particle_number = above_threshold.size + should_decay.size + should_not_decay.size
-        
-        if above_threshold.size < len(wstack):
-            print(f"Above threshold = {above_threshold.size/len(wstack)*100} %")
-        
-        assert particle_number == len(wstack), (
-                "Number of distributed particles not equal to number of initial particles")
+        if counts[0] < len(wstack):
+            print(f"Above threshold = {counts[0]/len(wstack)*100} %")
         
         self.working_stack.clear()
     
     
     def filter_by_slant_depth(self):
         wstack = self.working_stack_filter.valid()
-        self.xdepth_getter.get_decay_xdepth(wstack)
-        self.xdepth_getter.get_inter_xdepth(wstack)
+        with self.timer.stage("xdepth_getter.decay", len(wstack)):
+            self.xdepth_getter.get_decay_xdepth(wstack)
+        with self.timer.stage("xdepth_getter.inter", len(wstack)):
+            self.xdepth_getter.get_inter_xdepth(wstack)
         
         max_xdepth = self.stop_xdepth
-                
-        # Sort particles at the surface
-        at_surface = np.logical_and(wstack.xdepth_inter >= max_xdepth, 
-                                    wstack.xdepth_decay >= max_xdepth)
-        
-        not_at_surface = np.logical_not(at_surface)
-        
-        should_decay = np.isin(wstack.pid, self.force_decaying_pdgs)
-        should_not_decay = np.logical_not(should_decay)
-        
-        should_decay = np.where(np.logical_and(at_surface, should_decay))[0]
-        should_not_decay = np.where(np.logical_and(at_surface, should_not_decay))[0]
-        
-        
-        # Particles that should be decayed at surface
-        dfstack_portion = wstack[should_decay]
-        dfstack_portion.xdepth_stop[:] = max_xdepth
-        dfstack_portion.final_code[:] = 1
-        self.final_stack_decay.append(dfstack_portion)
-        
-        # Particles that are already at their final stage
-        fstack_portion = wstack[should_not_decay]
-        fstack_portion.xdepth_stop[:] = max_xdepth
-        fstack_portion.final_code[:] = 1
-        self.final_stack.append(fstack_portion)
-
-        # Sort particles which are still in the atmosphere
-        istack_true = np.logical_and(wstack.xdepth_inter < wstack.xdepth_decay, not_at_surface)
-        istack_true = np.where(istack_true)[0]
-        istack_portion = wstack[istack_true]        
-        istack_portion.xdepth_stop[:] = istack_portion.xdepth_inter
-        self.inter_stack = istack_portion
-        
-        dstack_true = np.logical_and(wstack.xdepth_inter > wstack.xdepth_decay, not_at_surface)
-        dstack_true = np.where(dstack_true)[0]
-        dstack_portion = wstack[dstack_true]
-        dstack_portion.xdepth_stop[:] = dstack_portion.xdepth_decay
-        self.decay_stack.append(dstack_portion)
-
-        
         
+        # 0: at surface and should decay, 1: at surface and final, 
+        # 2: interacting, 3: decaying, -1 (xdepth_inter == xdepth_decay): dropped
+        labels = particle_kernels.classify_slant_depth(wstack.xdepth_inter, 
+                                                       wstack.xdepth_decay,
+                                                       wstack.pid, max_xdepth,
+                                                       self.force_decaying_table)
+        
+        at_surface = np.logical_and(labels >= 0, labels <= 1)
+        wstack.xdepth_stop[:] = np.where(at_surface, max_xdepth, 
+                                         np.where(labels == 2, wstack.xdepth_inter, 
+                                                  wstack.xdepth_decay))
+        wstack.final_code[at_surface] = 1
+        
+        self.inter_stack.clear()
+        wstack.partition(labels, [self.final_stack_decay,
+                                  self.final_stack,
+                                  self.inter_stack,
+                                  self.decay_stack])
         
     
     def run_hadron_interactions(self):
         self.children_stack.clear()
-        self.rejection_stack.clear()
         
         if len(self.inter_stack) == 0:
             return
         
-        self.number_of_interactions += self.hadron_interaction.run_event_generator(
-                                                    parents = self.inter_stack, 
-                                                    children = self.children_stack, 
-                                                    failed_parents = self.rejection_stack)
-        
+        result = self.hadron_interaction.run_event_generator(parents = self.inter_stack, 
+                                                             children = self.children_stack)
+        self.number_of_interactions += result.number_of_events
         
+        self.thin(self.children_stack, result.parent_rows)
         self.id_generator.generate_ids(self.children_stack.valid().id)
         self.children_stack.valid().production_code[:] = 2
         
-        self.generated_stack.append(self.children_stack)
-        
-        # Filter particles participated in interactions
-        parents_true = np.logical_not(np.isin(self.inter_stack.valid().id, 
-                                              self.rejection_stack.valid().id))
-        parents = self.inter_stack[np.where(parents_true)[0]]
-        parents.valid().final_code[:] = 2
-        # And record them in archival stack
-        self.archival_stack.append(parents)
-        
-        if len(self.rejection_stack) > 0:
-            self.archival_stack.append(self.rejection_stack)
-            self.decay_stack.append(self.rejection_stack)
+        if self.history != "none":
+            self.generated_stack.append(self.children_stack)
+        
+        if self.history == "full":
+            # Particles participated in interactions
+            parents = self.inter_stack[result.processed()]
+            parents.final_code[:] = 2
+            # And record them in archival stack
+            self.archival_stack.append(parents)
+        
+        rejected = self.inter_stack[result.rejected()]
+        if len(rejected) > 0:
+            if self.history == "full":
+                self.archival_stack.append(rejected)
+            self.decay_stack.append(rejected)
             
-            rej_muons = np.where(np.isin(self.rejection_stack.valid().pid, 
-                                         np.array([-13, 13], dtype = np.int32)))[0]
+            rej_muons = np.where(np.logical_or(rejected.pid == 13, rejected.pid == -13))[0]
             if len(rej_muons) > 0:
-                print(f"Muons pdgs = {self.rejection_stack.pid[rej_muons]}"
-                      f" energy = {self.rejection_stack.energy[rej_muons]}")
+                print(f"Muons pdgs = {rejected.pid[rej_muons]}"
+                      f" energy = {rejected.energy[rej_muons]}")
         
 
         self.working_stack.clear()
@@ -266,37 +565,37 @@ class CascadeDriver:
         if len(self.decay_stack) == 0:
             return
         
-        self.rejection_stack.clear()
         self.working_stack.clear()
-        self.number_of_decays += self.decay_driver.run_decay(self.decay_stack, 
-                                                             decayed_particles=self.working_stack,
-                                                             stable_particles=self.rejection_stack)
-        
-        
-        # Filter particles participated in decay
-        parents_true = np.logical_not(np.isin(self.decay_stack.valid().id, 
-                                              self.rejection_stack.valid().id))
-        parents = self.decay_stack[np.where(parents_true)[0]]
-        # Final_code = 3 means decay
-        parents.valid().final_code[:] = 3
-        # And record them in archival stack
-        self.archival_stack.append(parents)
-        
+        result = self.decay_driver.run_decay(self.decay_stack, 
+                                             decayed_particles=self.working_stack)
+        self.number_of_decays += result.number_of_events
+        
+        if self.history == "full":
+            # Particles participated in decay
+            parents = self.decay_stack[result.processed()]
+            # Final_code = 3 means decay
+            parents.final_code[:] = 3
+            # And record them in archival stack
+            self.archival_stack.append(parents)
+        
+        self.thin(self.working_stack, result.parent_rows)
         self.id_generator.generate_ids(self.working_stack.valid().id)
-        self.generated_stack.append(self.working_stack)
+        if self.history != "none":
+            self.generated_stack.append(self.working_stack)
         
-        self.rejection_stack.valid().xdepth_stop[:] = self.stop_xdepth
+        stable = self.decay_stack[result.rejected()]
+        stable.xdepth_stop[:] = self.stop_xdepth
         
         
-        # self.debug_append_final_stack(self.rejection_stack) 
-        self.final_stack.append(self.rejection_stack) 
+        # self.debug_append_final_stack(stable) 
+        self.final_stack.append(stable) 
         
-        # Use rejection_stack again
+        # 0: final (final_code 1 or 4), 1: should be processed further
+        final_code = self.working_stack.valid().final_code
+        labels = np.where(np.logical_or(final_code == 1, final_code == 4), 0, 1).astype(np.int8)
         self.rejection_stack.clear()
-        should_be_finals = np.isin(self.working_stack.valid().final_code, np.array([1, 4], dtype=np.int32))
-        should_be_processed = np.logical_not(should_be_finals)
-        self.final_stack.append(self.working_stack[np.where(should_be_finals)[0]])
-        self.rejection_stack.append(self.working_stack[np.where(should_be_processed)[0]])
+        self.working_stack.valid().partition(labels, [self.final_stack, 
+                                                      self.rejection_stack])
         self.working_stack.clear()
         
         self.working_stack.append(self.rejection_stack)  
@@ -304,6 +603,21 @@ class CascadeDriver:
         self.decay_stack.clear()
         
         
+    def thin(self, pstack, parent_rows = None):
+        """Apply thinning to secondaries in pstack if thinning_level is set
+        
+        `parent_rows` (EngineResult.parent_rows) groups secondaries 
+        by parent, `parent_id` is used if None
+        """
+        if self.thinning_level is None or len(pstack) == 0:
+            return
+        
+        with self.timer.stage("thinning", len(pstack)):
+            shower_index = pstack.valid().shower_id - self._first_shower_id
+            self.number_of_thinned += self.thinning.thin(pstack, 
+                                                         self._thinning_energy[shower_index],
+                                                         parent_rows)
+        
     def run_decay_at_surface(self):
         
         # print(f"Run decay1, number = {len(self.final_stack_decay)}")
@@ -311,17 +625,96 @@ class CascadeDriver:
             return
         
         # print("Run decay2")
-        self.rejection_stack.clear()
         self.working_stack.clear()
         
-        self.number_of_decays += self.decay_driver.run_decay(self.final_stack_decay, 
-                                                             decayed_particles=self.working_stack,
-                                                             stable_particles=self.rejection_stack)
+        result = self.decay_driver.run_decay(self.final_stack_decay, 
+                                             decayed_particles=self.working_stack)
+        self.number_of_decays += result.number_of_events
         
         
         self.final_stack.append(self.working_stack)
-        self.final_stack.append(self.rejection_stack)
-        
+        self.final_stack.append(self.final_stack_decay[result.rejected()])
+        # Particles are decayed, don't decay them again in the next run
+        self.final_stack_decay.clear()
+        
+    # Stacks saved by `checkpoint`
+    checkpoint_stacks = ["final_stack",
+                         "final_stack_decay",
+                         "archival_stack",
+                         "generated_stack"]
+    
+    def checkpoint(self, path):
+        """Save state of accumulated runs to directory `path`
+        
+        Stacks are written with ParticleArray.save (".npz" files),
+        ids, counters and random states to "state.json". 
+        Call it between runs, `restore` continues the campaign.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        
+        for name in self.checkpoint_stacks:
+            getattr(self, name).save(path / f"{name}.npz")
+        
+        run_seeds = self.run_seeds
+        state = {"next_id": int(self.id_generator.generated_so_far()),
+                 "runs_number": self.runs_number,
+                 "number_of_interactions": self.number_of_interactions,
+                 "number_of_decays": self.number_of_decays,
+                 "number_of_thinned": self.number_of_thinned,
+                 "loop_execution_time": self.loop_execution_time,
+                 "initial_run": self.initial_run,
+                 "accumulate_runs": self.accumulate_runs,
+                 "run_seeds": {"entropy": run_seeds.entropy,
+                               "spawn_key": list(run_seeds.spawn_key),
+                               "n_children_spawned": run_seeds.n_children_spawned},
+                 "hadron_random_state": self.hadron_interaction.get_random_state()}
+        
+        with open(path / "state.json", "w") as state_file:
+            json.dump(state, state_file)
+    
+    def restore(self, path):
+        """Continue a campaign saved with `checkpoint(path)`
+        
+        The driver should be created with the same arguments and
+        `simulation_parameters` should be called before `restore`.
+        Xdepth sampling and the hadron event generator continue their 
+        random streams exactly, Pythia is reseeded with a seed 
+        derived from `seed` and the number of runs.
+        """
+        path = Path(path)
+        with open(path / "state.json") as state_file:
+            state = json.load(state_file)
+        
+        for name in self.checkpoint_stacks:
+            pstack = getattr(self, name)
+            pstack.clear()
+            pstack.append(ParticleArray.load(path / f"{name}.npz"))
+        
+        self.id_generator.set_next_id(state["next_id"])
+        self.runs_number = state["runs_number"]
+        self.number_of_interactions = state["number_of_interactions"]
+        self.number_of_decays = state["number_of_decays"]
+        self.number_of_thinned = state["number_of_thinned"]
+        self.loop_execution_time = state["loop_execution_time"]
+        self.initial_run = state["initial_run"]
+        self.accumulate_runs = state["accumulate_runs"]
+        
+        run_seeds = state["run_seeds"]
+        self.run_seeds = np.random.SeedSequence(run_seeds["entropy"],
+                                                spawn_key=tuple(run_seeds["spawn_key"]),
+                                                n_children_spawned=run_seeds["n_children_spawned"])
+        self.hadron_interaction.set_random_state(state["hadron_random_state"])
+        self.decay_driver.set_seed(np.random.SeedSequence(self.resume_seeds.entropy,
+                                                          spawn_key=self.resume_seeds.spawn_key 
+                                                          + (self.runs_number,)))
+    
+    def performance_report(self):
+        """Per stage wall time, calls, particles and particles/second
+        accumulated since the initial run (see StageTimer)
+        """
+        return self.timer.report()
+    
     def get_decaying_particles(self):
         return self.decay_stack
     
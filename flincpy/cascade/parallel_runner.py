@@ -0,0 +1,143 @@
+import numpy as np
+import multiprocessing
+import time
+
+from data_structs.particle_array import ParticleArray
+from data_structs.stage_timer import PerformanceReport
+from cascade.cascade_driver import CascadeDriver
+
+
+class ParallelRunResult:
+    """Merged output of ParallelCascadeRunner.run
+
+    `final_stack` has the final particles of all workers. Ids, parent ids
+    and shower ids are shifted per worker, so they stay unique as in one
+    accumulated CascadeDriver run. Counters are summed over workers,
+    `loop_execution_time` is the sum of worker loop times and
+    `wall_time` is the time of the whole parallel run. 
+    `performance_report` has per stage timing summed over workers.
+    """
+    def __init__(self, columns=None, compact_precision=False):
+        self.final_stack = ParticleArray(columns=columns, compact_precision=compact_precision)
+        self.number_of_interactions = 0
+        self.number_of_decays = 0
+        self.number_of_thinned = 0
+        self.loop_execution_time = 0
+        self.wall_time = 0
+        self.runs_number = 0
+        self.generated_ids = 0
+        self.performance_report = PerformanceReport({})
+        self.worker_stats = []
+
+    def add_worker(self, worker_result):
+        rows = worker_result["final_rows"]
+        # Make ids unique over workers, only for columns which are kept
+        if "id" in rows.dtype.names:
+            rows["id"] += self.generated_ids
+        if "parent_id" in rows.dtype.names and "generation_num" in rows.dtype.names:
+            produced = rows["generation_num"] > 0
+            rows["parent_id"][produced] += self.generated_ids
+        if "shower_id" in rows.dtype.names:
+            rows["shower_id"] += self.runs_number
+        self.final_stack._append_rows(rows)
+
+        self.number_of_interactions += worker_result["number_of_interactions"]
+        self.number_of_decays += worker_result["number_of_decays"]
+        self.number_of_thinned += worker_result["number_of_thinned"]
+        self.loop_execution_time += worker_result["loop_execution_time"]
+        self.runs_number += worker_result["runs_number"]
+        self.generated_ids += worker_result["generated_ids"]
+        self.performance_report.merge(worker_result["performance_report"])
+        self.worker_stats.append({key: value for key, value in worker_result.items()
+                                  if key != "final_rows"})
+
+    def get_final_particles(self):
+        return self.final_stack
+
+    def speedup(self):
+        """Ratio of summed worker loop time to wall time"""
+        if self.wall_time == 0:
+            return 0
+        return self.loop_execution_time / self.wall_time
+
+
+def _run_worker(driver_kwargs, simulation_kwargs, nruns):
+    """Run `nruns` accumulated runs in a new CascadeDriver
+
+    Executed in a worker process, so DPMJET and Pythia global state
+    is not shared with other workers.
+    """
+    cas_driver = CascadeDriver(**driver_kwargs)
+    cas_driver.simulation_parameters(**simulation_kwargs, accumulate_runs=True)
+    for _ in range(nruns):
+        cas_driver.run()
+
+    final_stack = cas_driver.final_stack
+    return {"final_rows": final_stack._rows().copy(),
+            "columns": final_stack.data_attributes,
+            "compact_precision": final_stack.compact_precision,
+            "number_of_interactions": cas_driver.number_of_interactions,
+            "number_of_decays": cas_driver.number_of_decays,
+            "number_of_thinned": cas_driver.number_of_thinned,
+            "loop_execution_time": cas_driver.loop_execution_time,
+            "runs_number": cas_driver.runs_number,
+            "generated_ids": int(cas_driver.id_generator.generated_so_far()),
+            "performance_report": cas_driver.performance_report()}
+
+
+class ParallelCascadeRunner:
+    """Run accumulated cascades in several worker processes
+
+    Every worker creates its own CascadeDriver with `driver_kwargs`
+    and its own seed sequence spawned from `seed`,
+    calls `simulation_parameters(**simulation_kwargs, accumulate_runs=True)`
+    and runs its share of runs. Workers are started with "spawn",
+    so no Fortran/C++ generator state is inherited from the parent process.
+
+    Example:
+        runner = ParallelCascadeRunner(dict(zenith_angle=0),
+                                       dict(pdg=2212, energy=1e5,
+                                            threshold_energy=1e3,
+                                            mceq_decaying_pdgs=[111]),
+                                       nworkers=8)
+        result = runner.run(10000)
+        result.final_stack, result.number_of_interactions
+    """
+    def __init__(self, driver_kwargs, simulation_kwargs, nworkers=None, seed=None):
+        self.driver_kwargs = dict(driver_kwargs)
+        self.simulation_kwargs = dict(simulation_kwargs)
+        self.simulation_kwargs.pop("accumulate_runs", None)
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        self.nworkers = nworkers
+        self.seed_sequence = seed
+        if not isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = np.random.SeedSequence(seed)
+
+    def split_runs(self, nruns):
+        """Number of runs for every worker"""
+        nworkers = max(1, min(self.nworkers, nruns))
+        runs_per_worker = np.full(nworkers, nruns // nworkers, dtype=np.int64)
+        runs_per_worker[:nruns % nworkers] += 1
+        return [int(n) for n in runs_per_worker]
+
+    def run(self, nruns):
+        runs_per_worker = self.split_runs(nruns)
+        worker_seeds = self.seed_sequence.spawn(len(runs_per_worker))
+
+        start_time = time.time()
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(len(runs_per_worker)) as pool:
+            worker_results = pool.starmap(_run_worker,
+                                          [(dict(self.driver_kwargs, seed=worker_seed),
+                                            self.simulation_kwargs,
+                                            nruns_worker)
+                                           for nruns_worker, worker_seed 
+                                           in zip(runs_per_worker, worker_seeds)])
+
+        result = ParallelRunResult(columns=worker_results[0]["columns"],
+                                   compact_precision=worker_results[0]["compact_precision"])
+        for worker_result in worker_results:
+            result.add_worker(worker_result)
+        result.wall_time = time.time() - start_time
+        return result
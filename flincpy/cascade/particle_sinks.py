@@ -0,0 +1,102 @@
+import numpy as np
+from pathlib import Path
+
+
+class EnergyHistogramSink:
+    """Accumulate energy histograms of final particles per pdg
+
+    Particles are counted with their `weight` (see HillasThinning),
+    if the final stack has this column.
+
+    Example:
+        sink = EnergyHistogramSink(np.geomspace(1, 1e5, 101))
+        cas_driver.set_sink(sink)
+        for _ in range(1000):
+            cas_driver.run()
+        bin_edges, hist = sink.histogram([13, -13])
+    """
+    def __init__(self, bins, pdgs=None):
+        """
+        Args:
+            bins (np.array): bin edges of energy
+            pdgs (list): pdgs to histogram, all pdgs if None
+        """
+        self.bins = np.asarray(bins)
+        self.pdgs = pdgs
+        self.counts = {}
+        self.runs_number = 0
+
+    def __call__(self, cascade_driver):
+        self.runs_number += cascade_driver.run_showers
+
+        final_stack = cascade_driver.final_stack.valid()
+        if len(final_stack) == 0:
+            return
+
+        groups = final_stack.group_by("pid")
+        energy = groups.sort(final_stack.energy)
+        weight = None
+        if "weight" in final_stack.data_attributes:
+            weight = groups.sort(final_stack.weight)
+        for pdg, segment in zip(groups.keys, groups.segments()):
+            pdg = int(pdg)
+            if self.pdgs is not None and pdg not in self.pdgs:
+                continue
+
+            hist, _ = np.histogram(energy[segment], bins = self.bins,
+                                   weights = None if weight is None else weight[segment])
+            if pdg in self.counts:
+                self.counts[pdg] += hist
+            else:
+                self.counts[pdg] = hist
+
+    def histogram(self, pdgs=None):
+        """Return bin edges and number of particles per run
+        summed over `pdgs` (all histogrammed pdgs if None)
+        """
+        if pdgs is None:
+            pdgs = self.counts.keys()
+
+        hist_values = np.zeros(len(self.bins) - 1)
+        for pdg in pdgs:
+            if pdg in self.counts:
+                hist_values += self.counts[pdg]
+
+        if self.runs_number > 0:
+            hist_values = hist_values/self.runs_number
+        return self.bins, hist_values
+
+
+class ParticleWriterSink:
+    """Append final particles (and optionally history) of every run to files
+
+    Particles are written with ParticleArray.save, so files are ".npz" or ".h5"
+    and can be read back with ParticleArray.load.
+    """
+    def __init__(self, path, history=False, compress=False, suffix=".npz"):
+        """
+        Args:
+            path (str or Path): directory for "final_stack<suffix>"
+                and, if `history`, "archival_stack<suffix>", "generated_stack<suffix>"
+            history (bool): write also archival and generated stacks
+            compress (bool): compress the data
+            suffix (str): ".npz" or ".h5"
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.history = history
+        self.compress = compress
+        self.suffix = suffix
+        self._append = False
+
+    def __call__(self, cascade_driver):
+        stacks = {"final_stack": cascade_driver.final_stack}
+        if self.history:
+            stacks["archival_stack"] = cascade_driver.archival_stack
+            stacks["generated_stack"] = cascade_driver.generated_stack
+
+        for name, pstack in stacks.items():
+            pstack.save(self.path / f"{name}{self.suffix}",
+                        append = self._append, compress = self.compress)
+        # Files from previous campaigns are overwritten by the first run
+        self._append = True
@@ -14,6 +14,11 @@ class IdGenerator:
 
     def generated_so_far(self):
         return self._next_id
+    
+    def set_next_id(self, next_id):
+        """Continue generation from `next_id` (e.g. after restore)
+        """
+        self._next_id = np.int64(next_id)
 
 
 if __name__ == "__main__":
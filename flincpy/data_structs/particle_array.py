@@ -1,6 +1,6 @@
 import numpy as np
 from enum import Enum
-import gc
+from data_structs import particle_kernels
 
 
 class FilterCode(Enum):
@@ -12,6 +12,27 @@ class FilterCode(Enum):
 class ParticleArray:
     """ParticleArray is data structure to keep particles and their properties
 
+        All columns are kept in one structured numpy array (`_buffer`),
+        and data attributes (`pid`, `energy`, ...) are views of its fields.
+        Growth, slicing, copy and append are therefore a single
+        operation on the whole row instead of a loop over columns.
+
+        `columns` is the schema of the array, i.e. the subset of 
+        `data_attributes` which exist in it (all of them by default).
+        Rows are copied between arrays with different schemas by column 
+        names, columns missing in the source are set to 0 
+        (or to `default_values`).
+        
+        `compact_precision=True` stores columns with `compact_data_types` 
+        (float32 energies and depths, narrow integer codes). It is meant
+        for history stacks, values are converted when rows are copied 
+        to or from float64 working stacks.
+
+        shower_id: index of the primary particle (shower) the particle 
+        belongs to, when several showers are simulated together
+
+        weight: statistical weight of the particle, 1 without thinning
+
         filter_code: is code to filter entries
         {1: interacting, 2: decaying, 3: final}
     """
@@ -30,10 +51,62 @@ class ParticleArray:
                        "filter_code",
                        "valid_code",
                        "id",
-                       "parent_id"]
-
-    def __init__(self, size=1000):
+                       "parent_id",
+                       "shower_id",
+                       "weight"]
+    
+    data_types = {"pid": _int_type,
+                  "energy": np.float64,
+                  "xdepth": np.float64,
+                  "xdepth_stop": np.float64,
+                  "generation_num": _int_type,
+                  "xdepth_decay": np.float64,
+                  "xdepth_inter": np.float64,
+                  "production_code": _int_type,
+                  "final_code": _int_type,
+                  "filter_code": _int_type,
+                  "valid_code": _int_type,
+                  "id": np.int64,
+                  "parent_id": np.int64,
+                  "shower_id": _int_type,
+                  "weight": np.float64}
+    
+    compact_data_types = {"pid": np.int32,
+                          "energy": np.float32,
+                          "xdepth": np.float32,
+                          "xdepth_stop": np.float32,
+                          "generation_num": np.int16,
+                          "xdepth_decay": np.float32,
+                          "xdepth_inter": np.float32,
+                          "production_code": np.int16,
+                          "final_code": np.int8,
+                          "filter_code": np.int8,
+                          "valid_code": np.int8,
+                          "id": np.int64,
+                          "parent_id": np.int64,
+                          "shower_id": np.int32,
+                          "weight": np.float32}
+    
+    # Values of columns which are not given in push 
+    # or are missing in the source of copied rows (0 for other columns)
+    default_values = {"weight": 1.0}
+    
+    # Columns needed for final spectra and parent links
+    lean_attributes = ["pid",
+                       "energy",
+                       "xdepth",
+                       "xdepth_stop",
+                       "generation_num",
+                       "id",
+                       "parent_id",
+                       "shower_id",
+                       "weight"]
 
+    def __init__(self, size=1000, columns=None, compact_precision=False):
+        
+        if columns is not None:
+            self.data_attributes = self._check_columns(columns)
+        self.compact_precision = compact_precision
         # Allocate memory
         if size is not None:
             self._allocate(size)
@@ -41,46 +114,70 @@ class ParticleArray:
             # Use is as view
             for attr in self.data_attributes:
                 setattr(self, attr, None)
+            self._buffer = None
             self._len = None
             self.data = None
+            
+    @classmethod
+    def _check_columns(cls, columns):
+        unknown = set(columns) - set(cls.data_types)
+        if unknown:
+            raise ValueError(f"Unknown columns {sorted(unknown)}")
+        
+        if "pid" not in columns:
+            raise ValueError("Column 'pid' is required")
+        
+        # Keep the order of data_attributes
+        return [attr for attr in cls.data_attributes if attr in columns]
+            
+    def _make_dtype(self):
+        # 8-byte fields go first, so that every column is aligned
+        # in the row without padding
+        data_types = self.compact_data_types if self.compact_precision else self.data_types
+        fields = [(attr, np.dtype(data_types[attr])) for attr in self.data_attributes]
+        fields.sort(key=lambda field: field[1].itemsize, reverse=True)
+        return np.dtype(fields, align=True)
 
     def _allocate(self, size):
-        self.pid = np.empty(size, dtype=self._int_type)
-        self.energy = np.empty(size)
-        self.xdepth = np.zeros(size)
-        self.xdepth_stop = np.zeros(size)
-        self.generation_num = np.empty(size, dtype=self._int_type)
-        self.xdepth_decay = np.zeros(size)
-        self.xdepth_inter = np.zeros(size)
-        self.production_code = np.empty(size, dtype=self._int_type)
-        self.final_code = np.empty(size, dtype=self._int_type)
-        self.filter_code = np.empty(size, dtype=self._int_type)
-        self.valid_code = np.zeros(size, dtype=self._int_type)
-        self.id = np.zeros(size, dtype=np.int64)
-        self.parent_id = np.zeros(size, dtype=np.int64)
+        self._bind(np.zeros(size, dtype=self._make_dtype()))
         self.data = self
         self._len = 0
+        
+    def _bind(self, buffer):
+        """Use `buffer` as storage and make data attributes views of its fields
+        """
+        self._buffer = buffer
+        self._dtype = buffer.dtype
+        for attr in self.data_attributes:
+            setattr(self, attr, buffer[attr])
 
     def _increase_size(self, factor=2):
         old_size = self.reserved_size()
-        new_size = factor * old_size
+        new_size = factor * max(old_size, 1)
         
         if new_size > self._max_size:
             raise MemoryError("Too large array")
         
-        new_array = ParticleArray(new_size)
-        for attr in self.data_attributes:
-            self_value = getattr(self, attr)
-            new_value = getattr(new_array, attr)
-            new_value[0:old_size] = self_value
-            setattr(self, attr, new_value)
-        new_array = self    
-        gc.collect()
+        new_buffer = np.zeros(new_size, dtype=self._dtype)
+        new_buffer[0:self._len] = self._buffer[0:self._len]
+        self._bind(new_buffer)
         
     def _adjust_capacity(self, size):
-        factor = int(np.ceil(size/self.reserved_size()))
+        factor = int(np.ceil(size/max(self.reserved_size(), 1)))
         if factor > 1:
             self._increase_size(factor)
+            
+    def _row_key(self, key):
+        """Integer key is converted to slice of length 1,
+        so that indexing always gives an array of rows
+        """
+        if isinstance(key, (int, np.integer)):
+            key = range(self.reserved_size())[key]
+            return slice(key, key + 1)
+        return key
+    
+    def _rows(self):
+        return self._buffer[0:self._len]
         
 
     def __len__(self):
@@ -88,12 +185,16 @@ class ParticleArray:
     
     
     def __getitem__(self, key):
-        view_stack = ParticleArray(None)
-        for attr in self.data_attributes:
-            value = getattr(self, attr)[key]
-            setattr(view_stack, attr, value)
-
-        view_stack._len = view_stack.pid.size
+        """Slices and integers give a view of the array, 
+        index arrays and masks (advanced indexing) give a lazy 
+        ParticleSelection which doesn't copy the data
+        """
+        if not isinstance(key, (slice, int, np.integer)):
+            return ParticleSelection(self, key)
+        
+        view_stack = ParticleArray(None, columns=self.data_attributes, compact_precision=self.compact_precision)
+        view_stack._bind(self._buffer[self._row_key(key)])
+        view_stack._len = len(view_stack._buffer)
         view_stack.data = self
         return view_stack
         
@@ -103,19 +204,16 @@ class ParticleArray:
         assignment happens in valid part of the array
         """
 
-        if not isinstance(other, ParticleArray):
+        if not isinstance(other, (ParticleArray, ParticleSelection)):
             raise ValueError("Argument is not an object of ParticleArray class")
         
-        for attr in self.data_attributes:
-            other_value = getattr(other, attr)
-            self_value = getattr(self, attr)
-            self_value[slice_] = other_value
+        _assign_rows(self._buffer, self._row_key(slice_), other._rows())
         
         
         
 
     def reserved_size(self):
-        return len(self.pid)
+        return len(self._buffer)
 
     def push(self, **kwargs):
 
@@ -149,9 +247,16 @@ class ParticleArray:
                 else:
                     data_attr[dst_slice] = value[src_slice]
         self._len = dst_end
-        self.valid_code[dst_slice] = 1
+        if "valid_code" in self.data_attributes:
+            self.valid_code[dst_slice] = 1
+        self._set_defaults(dst_slice, kwargs)
         return dst_slice
     
+    def _set_defaults(self, dst_slice, kwargs):
+        for name, value in self.default_values.items():
+            if name not in kwargs and name in self.data_attributes:
+                getattr(self, name)[dst_slice] = value
+    
     def push_one(self, **kwargs):
         pid = kwargs.get("pid")
         if pid is None:
@@ -168,15 +273,16 @@ class ParticleArray:
             if data_attr is not None:
                 data_attr[dst_slice] = np.copy(value)
         self._len = dst_end
-        self.valid_code[dst_slice] = 1
+        if "valid_code" in self.data_attributes:
+            self.valid_code[dst_slice] = 1
+        self._set_defaults(dst_slice, kwargs)
         return dst_slice
 
 
     def copy(self, *, src_slice=None, dst_slice=None, size=None):
         if size is None:
-            copy_stack = ParticleArray(self.reserved_size())
-        else:
-            copy_stack = ParticleArray(size)
+            size = self.reserved_size()
+        copy_stack = ParticleArray(size, columns=self.data_attributes, compact_precision=self.compact_precision)
 
         if src_slice is None:
             src_slice = slice(0, None)   
@@ -186,11 +292,7 @@ class ParticleArray:
             copy_stack._len = len(self.pid[src_slice])
             dst_slice = slice(0, copy_stack._len)
         
-        for attr in self.data_attributes:
-            src_value = getattr(self, attr)[src_slice]
-            getattr(copy_stack, attr)[dst_slice] = np.copy(src_value)
-        
-        copy_stack.valid_code[dst_slice] = np.copy(self.valid_code[src_slice])
+        copy_stack._buffer[dst_slice] = self._buffer[src_slice]
         return copy_stack
 
     def clear(self, size=None):
@@ -202,6 +304,14 @@ class ParticleArray:
                 self._len = 0
         return
 
+    def keep(self, mask):
+        """Keep only valid rows where `mask` is True, in place 
+        and in the same order
+        """
+        rows = self._rows()[mask]
+        self._buffer[0:len(rows)] = rows
+        self._len = len(rows)
+
     def pop(self, size=None):
         if size is None or self._len < size:
             pop_slice = slice(0, None)
@@ -216,29 +326,246 @@ class ParticleArray:
         """Appends only valid part of other array
         """
         
-        if not isinstance(other, ParticleArray):
+        if not isinstance(other, (ParticleArray, ParticleSelection)):
             raise ValueError("argument is not a ParticleArray object")
         
         if len(other) == 0:
             return self
         
-        other_slice =  slice(0, len(other))
         new_len = len(self) + len(other)
         self_slice = slice(len(self), new_len)
         
         self._adjust_capacity(new_len)
-
-        for attr in other.data_attributes:
-            val_other = getattr(other, attr)
-            val_self = getattr(self, attr)
-            val_self[self_slice] = val_other[other_slice]
+        other._take_rows(out=self._buffer[self_slice])
             
         self._len = new_len
         return self    
             
+    def _append_rows(self, rows):
+        new_len = len(self) + len(rows)
+        self._adjust_capacity(new_len)
+        _assign_rows(self._buffer, slice(len(self), new_len), rows)
+        self._len = new_len
+    
+    def partition(self, labels, destinations):
+        """Append valid rows to destination arrays according to labels
+        
+        Row `i` goes to `destinations[labels[i]]`, rows with negative label
+        or with None destination are dropped. Rows are grouped by label
+        with one counting sort and one gather (see particle_kernels), 
+        then each destination gets one contiguous block.
+
+        Args:
+            labels (np.array): integer label for each valid row
+            destinations (list): ParticleArray objects or None
+
+        Returns:
+            np.array: number of rows for each destination
+        """
+        labels = np.asarray(labels)
+        if len(labels) != len(self):
+            raise ValueError("Number of labels is not equal to number of particles")
+        
+        if len(labels) > 0 and labels.max() >= len(destinations):
+            raise ValueError(f"Label {labels.max()} is out of range "
+                             f"for {len(destinations)} destinations")
+        
+        if len(destinations) < np.iinfo(np.int8).max and labels.dtype != np.int8:
+            # All negative labels are dropped, keep them negative in int8
+            labels = np.maximum(labels, -1).astype(np.int8)
+        
+        order, offsets = particle_kernels.counting_sort(labels, len(destinations))
+        rows = np.empty(len(order), dtype=self._dtype)
+        particle_kernels.take_rows(self._rows(), order, rows)
+        
+        for i, destination in enumerate(destinations):
+            if destination is None or offsets[i] == offsets[i + 1]:
+                continue
+            destination._append_rows(rows[offsets[i]:offsets[i + 1]])
+        return np.diff(offsets)
+    
+    def save(self, path, append=False, compress=False):
+        """Save valid rows to ".npz" or ".h5" file, see particle_io
+        """
+        from data_structs.particle_io import save_particles
+        save_particles(self, path, append=append, compress=compress)
+        
+    @staticmethod
+    def load(path):
+        """Load ParticleArray from ".npz" or ".h5" file, see particle_io
+        """
+        from data_structs.particle_io import load_particles
+        return load_particles(path)
+    
+    def group_by(self, column):
+        """Segmentation of valid rows by values of `column`, see ParticleGroups
+        """
+        return ParticleGroups(getattr(self, column)[0:self._len])
+    
+    def _take_rows(self, out):
+        _assign_rows(out, slice(None), self._rows())
+            
     def valid(self):
         return self[0:self._len]  
 
+
+def _assign_rows(buffer, key, rows):
+    """Set `buffer[key] = rows` matching columns by names
+    """
+    if buffer.dtype == rows.dtype:
+        buffer[key] = rows
+        return
+    
+    for name in buffer.dtype.names:
+        if name in rows.dtype.fields:
+            buffer[name][key] = rows[name]
+        else:
+            buffer[name][key] = ParticleArray.default_values.get(name, 0)
+
+
+class ParticleGroups:
+    """Rows grouped by equal values of a column
+    
+        `order` is a stable sort permutation of the values, `keys` are 
+        unique values and rows `order[offsets[i]:offsets[i + 1]]` have
+        value `keys[i]`. Computed once, it can be used by several per-species 
+        kernels: `sort` an array, process contiguous `segments()`, 
+        and `unsort` the result.
+    """
+    
+    def __init__(self, values):
+        values = np.asarray(values)
+        self.order = np.argsort(values, kind="stable")
+        sorted_values = values[self.order]
+        starts = np.flatnonzero(np.concatenate(([True], sorted_values[1:] != sorted_values[:-1])))
+        if len(values) == 0:
+            starts = starts[0:0]
+        self.keys = sorted_values[starts]
+        self.offsets = np.append(starts, len(values))
+        
+    def __len__(self):
+        return len(self.keys)
+    
+    def segments(self):
+        return [slice(start, end) for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+    
+    def sort(self, array):
+        return array[self.order]
+    
+    def unsort(self, sorted_array):
+        array = np.empty_like(sorted_array)
+        array[self.order] = sorted_array
+        return array
+
+
+class _SelectedColumn(np.ndarray):
+    """Column of ParticleSelection materialized from the parent column.
+    
+    Item assignment to the column is also written to the parent column. 
+    Arrays derived from it (slices, results of operations) are plain 
+    copies and are not written through.
+    """
+    
+    def __array_finalize__(self, obj):
+        self._target = None
+        self._index = None
+        
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self._target is not None:
+            self._target[self._index[key]] = self.view(np.ndarray)[key]
+
+
+class ParticleSelection:
+    """Lazy selection of rows of ParticleArray given by index array or mask
+    
+        Nothing is copied on creation. A column is gathered from the parent
+        only when it is read, and item assignment to the column 
+        (`selection.energy[:] = ...`) or assignment of the column 
+        (`selection.energy = ...`) is written to the parent.
+        
+        Selection is valid as long as the selected rows of the parent 
+        are not changed by other means. Use `compact()` to get independent
+        ParticleArray, appending selection to ParticleArray gathers 
+        the rows directly into it.
+    """
+    
+    def __init__(self, parent, key):
+        self.__dict__["data"] = parent
+        self.__dict__["_index"] = self._make_index(key)
+        self.__dict__["_len"] = len(self._index)
+        self.__dict__["data_attributes"] = parent.data_attributes
+        
+    @staticmethod
+    def _make_index(key):
+        # np.where returns tuple
+        if isinstance(key, tuple) and len(key) == 1:
+            key = key[0]
+        key = np.asarray(key)
+        if key.dtype == bool:
+            return np.flatnonzero(key)
+        return key.astype(np.intp, copy=False)
+        
+    def __getattr__(self, name):
+        if name not in self.data_attributes:
+            raise AttributeError(f"'ParticleSelection' object has no attribute '{name}'")
+        
+        parent_column = getattr(self.data, name)
+        column = parent_column[self._index].view(_SelectedColumn)
+        column._target = parent_column
+        column._index = self._index
+        # Keep materialized column, next access doesn't call __getattr__
+        self.__dict__[name] = column
+        return column
+    
+    def __setattr__(self, name, value):
+        if name not in self.data_attributes:
+            raise AttributeError(f"Can't set attribute '{name}' of ParticleSelection")
+        
+        getattr(self.data, name)[self._index] = value
+        self.__dict__.pop(name, None)
+    
+    def __len__(self):
+        return self._len
+    
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key + 1 if key != -1 else None)
+        elif not isinstance(key, slice):
+            key = self._make_index(key)
+        return ParticleSelection(self.data, self._index[key])
+    
+    def _rows(self):
+        return self.data._buffer[self._index]
+    
+    def _take_rows(self, out):
+        if out.dtype == self.data._buffer.dtype:
+            particle_kernels.take_rows(self.data._buffer, self._index, out)
+        else:
+            _assign_rows(out, slice(None), self._rows())
+    
+    def valid(self):
+        return self
+    
+    def group_by(self, column):
+        return ParticleGroups(getattr(self, column))
+    
+    def reserved_size(self):
+        return self._len
+    
+    def compact(self):
+        """Materialize selection as independent ParticleArray
+        """
+        compact_stack = ParticleArray(None, columns=self.data_attributes, 
+                                      compact_precision=self.data.compact_precision)
+        compact_stack._bind(self._rows())
+        compact_stack._len = self._len
+        compact_stack.data = compact_stack
+        return compact_stack
+    
+    def copy(self):
+        return self.compact()
+
 if __name__ == "__main__":
         
     def test_initialization():
@@ -274,7 +601,8 @@ if __name__ == "__main__":
         pstack1.push(pid = np.array([888, 342, 777]), energy = 20, xdepth = 13)
         
         some_slice = [0, 2]
-        pstack2 = pstack1[some_slice]
+        # Selection is lazy, compact() gives an independent copy
+        pstack2 = pstack1[some_slice].compact()
         print(f"pstack2.pid = {pstack2.pid}")
         
         
@@ -0,0 +1,171 @@
+"""Saving and loading of ParticleArray
+
+Two formats are supported, chosen by the file suffix:
+    ".npz": zip archive with rows in "chunk_NNNNNN.npy" members and 
+        description in "meta.json", every save with `append=True`
+        adds a new chunk member
+    ".h5", ".hdf5": HDF5 file (requires h5py) with resizable chunked 
+        dataset "particles" and description in its attributes
+        
+Rows are written and read as whole structured arrays, 
+loading is one bulk read per chunk into preallocated ParticleArray.
+"""
+import json
+import zipfile
+import numpy as np
+from pathlib import Path
+from data_structs.particle_array import ParticleArray, _assign_rows
+
+_hdf5_suffixes = [".h5", ".hdf5"]
+
+
+def _meta(pstack):
+    return {"columns": pstack.data_attributes, "compact_precision": pstack.compact_precision}
+
+
+def _rows_as(rows, columns, compact_precision):
+    """Convert rows to dtype of the array with `columns` and `compact_precision`,
+    `rows` are returned as they are if the dtype is the same
+    """
+    dtype = ParticleArray(None, columns=columns, 
+                          compact_precision=compact_precision)._make_dtype()
+    if dtype == rows.dtype:
+        return rows
+    converted = np.zeros(len(rows), dtype=dtype)
+    _assign_rows(converted, slice(None), rows)
+    return converted
+
+
+def save_particles(pstack, path, append=False, compress=False):
+    """Save valid rows of `pstack` to `path`
+    
+    Args:
+        pstack (ParticleArray): particles to save
+        path (str or Path): ".npz" or ".h5"/".hdf5" file
+        append (bool): add rows to existing file, rows are converted 
+            to columns and precision of the file
+        compress (bool): compress the data
+    """
+    path = Path(path)
+    if not path.exists():
+        append = False
+        
+    if path.suffix in _hdf5_suffixes:
+        _save_hdf5(pstack, path, append, compress)
+    else:
+        _save_npz(pstack, path, append, compress)
+        
+
+def load_particles(path):
+    """Load ParticleArray saved by `save_particles`
+    """
+    path = Path(path)
+    if path.suffix in _hdf5_suffixes:
+        return _load_hdf5(path)
+    return _load_npz(path)
+    
+
+def _save_npz(pstack, path, append, compress):
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    
+    with zipfile.ZipFile(path, "a" if append else "w", compression=compression) as zfile:
+        if append:
+            meta = json.loads(zfile.read("meta.json"))
+        else:
+            meta = _meta(pstack)
+            zfile.writestr("meta.json", json.dumps(meta))
+        
+        rows = _rows_as(pstack._rows(), meta["columns"], meta["compact_precision"])
+        nchunks = len([name for name in zfile.namelist() if name.startswith("chunk_")])
+        with zfile.open(f"chunk_{nchunks:06d}.npy", "w", force_zip64=True) as chunk_file:
+            np.lib.format.write_array(chunk_file, rows, allow_pickle=False)
+
+
+def _read_npy_header(chunk_file):
+    version = np.lib.format.read_magic(chunk_file)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(chunk_file)
+    return np.lib.format.read_array_header_2_0(chunk_file)
+    
+
+def _load_npz(path):
+    with zipfile.ZipFile(path, "r") as zfile:
+        meta = json.loads(zfile.read("meta.json"))
+        chunk_names = sorted(name for name in zfile.namelist() if name.startswith("chunk_"))
+        
+        headers = []
+        for name in chunk_names:
+            with zfile.open(name) as chunk_file:
+                headers.append(_read_npy_header(chunk_file))
+        total = sum(shape[0] for shape, _, _ in headers)
+        
+        pstack = ParticleArray(max(total, 1), columns=meta["columns"], compact_precision=meta["compact_precision"])
+        start = 0
+        for name, (shape, _, dtype) in zip(chunk_names, headers):
+            end = start + shape[0]
+            with zfile.open(name) as chunk_file:
+                _read_npy_header(chunk_file)
+                if dtype == pstack._dtype:
+                    chunk_file.readinto(pstack._buffer[start:end].view(np.uint8))
+                else:
+                    rows = np.frombuffer(chunk_file.read(), dtype=dtype)
+                    _assign_rows(pstack._buffer, slice(start, end), rows)
+            start = end
+            
+    pstack._len = total
+    return pstack
+
+
+def _save_hdf5(pstack, path, append, compress):
+    import h5py
+    
+    with h5py.File(path, "a" if append else "w") as hfile:
+        if append:
+            dataset = hfile["particles"]
+            rows = _rows_as(pstack._rows(), 
+                            list(dataset.attrs["columns"]), 
+                            bool(dataset.attrs["compact_precision"]))
+            start = dataset.shape[0]
+            dataset.resize((start + len(rows),))
+            dataset[start:] = rows
+        else:
+            rows = pstack._rows()
+            dataset = hfile.create_dataset("particles", data=rows,
+                                           maxshape=(None,), chunks=True,
+                                           compression="gzip" if compress else None)
+            dataset.attrs["columns"] = pstack.data_attributes
+            dataset.attrs["compact_precision"] = pstack.compact_precision
+            
+            
+def _load_hdf5(path):
+    import h5py
+    
+    with h5py.File(path, "r") as hfile:
+        dataset = hfile["particles"]
+        total = dataset.shape[0]
+        pstack = ParticleArray(max(total, 1), 
+                               columns=list(dataset.attrs["columns"]), 
+                               compact_precision=bool(dataset.attrs["compact_precision"]))
+        if total > 0:
+            if dataset.dtype == pstack._dtype:
+                dataset.read_direct(pstack._buffer, np.s_[0:total], np.s_[0:total])
+            else:
+                _assign_rows(pstack._buffer, slice(0, total), dataset[...])
+    
+    pstack._len = total
+    return pstack
+
+
+if __name__ == "__main__":
+    import tempfile
+    
+    pstack = ParticleArray(10)
+    pstack.push(pid = np.array([13, -13, 14]), energy = np.array([1e1, 1e2, 1e3]), xdepth = 100)
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "final_stack.npz"
+        pstack.save(path)
+        pstack.save(path, append=True)
+        loaded = ParticleArray.load(path)
+        print(f"len = {len(loaded)}, pid = {loaded.valid().pid}")
+        print(f"energy = {loaded.valid().energy}")
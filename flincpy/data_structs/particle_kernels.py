@@ -0,0 +1,185 @@
+"""Kernels for ParticleArray bookkeeping and driver routing
+
+If numba is installed the kernels are compiled loops, otherwise 
+(or if `use_numba` is set to False) the numpy versions are used.
+Both versions give the same results.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+use_numba = numba is not None
+
+
+class PdgTable:
+    """Lookup table for membership test of pdg codes, replaces np.isin 
+    """
+    def __init__(self, pdgs):
+        pdgs = np.asarray(pdgs, dtype=np.int64).ravel()
+        self.offset = int(np.max(np.abs(pdgs))) if len(pdgs) > 0 else 0
+        self.table = np.zeros(2 * self.offset + 1, dtype=np.bool_)
+        self.table[pdgs + self.offset] = True
+        
+    def contains(self, pid):
+        pid = np.asarray(pid, dtype=np.int64)
+        inside = np.abs(pid) <= self.offset
+        result = np.zeros(len(pid), dtype=np.bool_)
+        result[inside] = self.table[pid[inside] + self.offset]
+        return result
+
+
+def _counting_sort_numpy(labels, nlabels):
+    counts = np.bincount(labels[labels >= 0], minlength=nlabels)
+    # Rows with negative labels are at the beginning
+    order = np.argsort(labels, kind="stable")[len(labels) - np.sum(counts):]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return order, offsets
+
+
+def _counting_sort_loop(labels, nlabels):
+    offsets = np.zeros(nlabels + 1, dtype=np.int64)
+    for i in range(len(labels)):
+        if labels[i] >= 0:
+            offsets[labels[i] + 1] += 1
+    for i in range(nlabels):
+        offsets[i + 1] += offsets[i]
+        
+    position = offsets[0:nlabels].copy()
+    order = np.empty(offsets[nlabels], dtype=np.intp)
+    for i in range(len(labels)):
+        label = labels[i]
+        if label >= 0:
+            order[position[label]] = i
+            position[label] += 1
+    return order, offsets
+
+
+def _take_words_loop(src, index, dst):
+    nwords = src.shape[1]
+    for i in range(len(index)):
+        row = index[i]
+        for word in range(nwords):
+            dst[i, word] = src[row, word]
+        
+
+def _classify_energy_numpy(energy, pid, threshold, decay_table):
+    should_decay = decay_table.contains(pid)
+    return np.where(energy > threshold, 0, np.where(should_decay, 1, 2)).astype(np.int8)
+
+
+def _classify_energy_loop(energy, pid, threshold, table, offset):
+    labels = np.empty(len(energy), dtype=np.int8)
+    for i in range(len(energy)):
+        if energy[i] > threshold:
+            labels[i] = 0
+        elif abs(pid[i]) <= offset and table[pid[i] + offset]:
+            labels[i] = 1
+        else:
+            labels[i] = 2
+    return labels
+
+
+def _classify_slant_depth_numpy(xdepth_inter, xdepth_decay, pid, max_xdepth, decay_table):
+    at_surface = np.logical_and(xdepth_inter >= max_xdepth, 
+                                xdepth_decay >= max_xdepth)
+    not_at_surface = np.logical_not(at_surface)
+    should_decay = decay_table.contains(pid)
+    
+    return np.select([np.logical_and(at_surface, should_decay),
+                      at_surface,
+                      np.logical_and(xdepth_inter < xdepth_decay, not_at_surface),
+                      np.logical_and(xdepth_inter > xdepth_decay, not_at_surface)], 
+                     [0, 1, 2, 3], default=-1).astype(np.int8)
+
+
+def _classify_slant_depth_loop(xdepth_inter, xdepth_decay, pid, max_xdepth, table, offset):
+    labels = np.empty(len(pid), dtype=np.int8)
+    for i in range(len(pid)):
+        if xdepth_inter[i] >= max_xdepth and xdepth_decay[i] >= max_xdepth:
+            if abs(pid[i]) <= offset and table[pid[i] + offset]:
+                labels[i] = 0
+            else:
+                labels[i] = 1
+        elif xdepth_inter[i] < xdepth_decay[i]:
+            labels[i] = 2
+        elif xdepth_inter[i] > xdepth_decay[i]:
+            labels[i] = 3
+        else:
+            labels[i] = -1
+    return labels
+
+
+if numba is not None:
+    _counting_sort_numba = numba.njit(cache=True)(_counting_sort_loop)
+    _take_words_numba = numba.njit(cache=True)(_take_words_loop)
+    _classify_energy_numba = numba.njit(cache=True)(_classify_energy_loop)
+    _classify_slant_depth_numba = numba.njit(cache=True)(_classify_slant_depth_loop)
+
+
+def counting_sort(labels, nlabels):
+    """Group indices of `labels` by label value
+    
+    Args:
+        labels (np.array): integer labels, negative labels are dropped
+        nlabels (int): number of labels, labels should be < nlabels
+
+    Returns:
+        (np.array, np.array): stable order of indices with non-negative labels,
+        and offsets, so that order[offsets[i]:offsets[i + 1]] have label i
+    """
+    labels = np.asarray(labels)
+    if len(labels) > 0 and np.max(labels) >= nlabels:
+        raise ValueError("Label is larger than number of destinations")
+    
+    if use_numba:
+        return _counting_sort_numba(labels, nlabels)
+    return _counting_sort_numpy(labels, nlabels)
+
+
+def take_rows(buffer, index, out):
+    """Gather rows `out[:] = buffer[index]` of structured arrays with the same dtype
+    """
+    if (use_numba and buffer.flags.c_contiguous and out.flags.c_contiguous
+        and len(index) > 0):
+        # The kernel has no bounds check, raise as np.take does
+        if index.min() < -len(buffer) or index.max() >= len(buffer):
+            raise IndexError(f"Row index is out of bounds for {len(buffer)} rows")
+        if len(out) != len(index):
+            raise ValueError("Output size is not equal to number of indices")
+        # Copy rows as machine words
+        itemsize = buffer.dtype.itemsize
+        for word_type in [np.uint64, np.uint32, np.uint16, np.uint8]:
+            if itemsize % np.dtype(word_type).itemsize == 0:
+                break
+        nwords = itemsize // np.dtype(word_type).itemsize
+        _take_words_numba(buffer.view(word_type).reshape(-1, nwords),
+                          index, 
+                          out.view(word_type).reshape(-1, nwords))
+    else:
+        np.take(buffer, index, out=out)
+
+
+def classify_energy(energy, pid, threshold, decay_table):
+    """Labels for CascadeDriver.filter_by_energy
+    
+    0: above threshold, 1: below threshold and pid in `decay_table`, 2: below threshold
+    """
+    if use_numba:
+        return _classify_energy_numba(energy, pid, threshold, 
+                                      decay_table.table, decay_table.offset)
+    return _classify_energy_numpy(energy, pid, threshold, decay_table)
+
+
+def classify_slant_depth(xdepth_inter, xdepth_decay, pid, max_xdepth, decay_table):
+    """Labels for CascadeDriver.filter_by_slant_depth
+    
+    0: at surface and pid in `decay_table`, 1: at surface, 2: interacting, 
+    3: decaying, -1: xdepth_inter == xdepth_decay
+    """
+    if use_numba:
+        return _classify_slant_depth_numba(xdepth_inter, xdepth_decay, pid, max_xdepth,
+                                           decay_table.table, decay_table.offset)
+    return _classify_slant_depth_numpy(xdepth_inter, xdepth_decay, pid, max_xdepth, decay_table)
@@ -0,0 +1,112 @@
+import json
+import numpy as np
+from pathlib import Path
+from data_structs.particle_array import ParticleArray
+
+
+class MemmapParticleArray(ParticleArray):
+    """ParticleArray kept in a file on disk through np.memmap
+    
+        The file grows by `chunk_size` rows, so there is no size limit 
+        except the disk. Description of the file (columns, precision, 
+        number of valid rows) is kept next to it in `<path>.json`
+        and written by `flush()`.
+        
+        Views and selections of the array are the same as for ParticleArray,
+        only pages which are accessed are read from the disk.
+    """
+    
+    def __init__(self, path, size=None, columns=None, compact_precision=False, 
+                 chunk_size=1048576):
+        self.path = Path(path)
+        self.chunk_size = chunk_size
+        self._mode = "w+"
+        if size is None:
+            size = chunk_size
+        super().__init__(size, columns=columns, compact_precision=compact_precision)
+        self.flush()
+        
+    @staticmethod
+    def _meta_path(path):
+        path = Path(path)
+        return path.with_name(path.name + ".json")
+    
+    @classmethod
+    def open(cls, path, mode="r"):
+        """Open array written before
+        
+        Args:
+            path (str or Path): path to the data file
+            mode (str): np.memmap mode, "r" read only, "r+" read/write,
+                "c" copy-on-write (changes are not written to the disk)
+        """
+        with open(cls._meta_path(path)) as meta_file:
+            meta = json.load(meta_file)
+            
+        pstack = cls.__new__(cls)
+        pstack.path = Path(path)
+        pstack.chunk_size = meta["chunk_size"]
+        pstack._mode = mode
+        pstack.data_attributes = meta["columns"]
+        pstack.compact_precision = meta["compact_precision"]
+        dtype = pstack._make_dtype()
+        if dtype.itemsize != meta["itemsize"]:
+            raise ValueError(f"Row size in {path} doesn't match ParticleArray columns")
+        
+        pstack._bind(np.memmap(path, dtype=dtype, mode=mode, shape=(meta["reserved"],)))
+        pstack.data = pstack
+        pstack._len = meta["len"]
+        return pstack
+    
+    def _allocate(self, size):
+        self._bind(np.memmap(self.path, dtype=self._make_dtype(), 
+                             mode=self._mode, shape=(size,)))
+        self._mode = "r+"
+        self.data = self
+        self._len = 0
+        
+    def _adjust_capacity(self, size):
+        if size > self.reserved_size():
+            self._increase_size(int(np.ceil(size/self.chunk_size)) * self.chunk_size)
+        
+    def _increase_size(self, new_size):
+        """Extend file to `new_size` rows and map it again
+        """
+        self._buffer.flush()
+        with open(self.path, "r+b") as data_file:
+            data_file.truncate(new_size * self._dtype.itemsize)
+        self._bind(np.memmap(self.path, dtype=self._dtype, 
+                             mode="r+", shape=(new_size,)))
+        
+    def flush(self):
+        """Write data and description to the disk
+        """
+        if self._mode != "r":
+            self._buffer.flush()
+        
+        meta = {"columns": self.data_attributes,
+                "compact_precision": self.compact_precision,
+                "itemsize": self._dtype.itemsize,
+                "reserved": self.reserved_size(),
+                "chunk_size": self.chunk_size,
+                "len": self._len}
+        if self._mode in ["w+", "r+"]:
+            with open(self._meta_path(self.path), "w") as meta_file:
+                json.dump(meta, meta_file)
+        
+        
+if __name__ == "__main__":
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "archival_stack.dat"
+        pstack = MemmapParticleArray(path, chunk_size=1000, compact_precision=True)
+        for i in range(5):
+            pstack.push(pid = np.full(700, 13, dtype=np.int32), 
+                        energy = np.geomspace(1, 1e3, 700), xdepth = i)
+        pstack.flush()
+        print(f"len = {len(pstack)}, reserved = {pstack.reserved_size()}")
+        
+        rstack = MemmapParticleArray.open(path)
+        print(f"len = {len(rstack)}, xdepth = {np.unique(rstack.valid().xdepth)}")
+        print(f"energy sum = {np.sum(rstack.valid().energy, dtype=np.float64)}")
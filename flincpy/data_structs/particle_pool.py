@@ -0,0 +1,81 @@
+import numpy as np
+from data_structs.particle_array import ParticleArray
+
+
+class ParticleArrayPool:
+    """Pool of ParticleArray objects which are reused instead of allocated
+    
+        `acquire(size)` gives an array with at least `size` reserved rows,
+        taken from the free arrays if possible (hit) or newly allocated 
+        with size rounded up to the power of 2 (miss). `release(pstack)` 
+        clears the array and takes it back.
+        
+        Don't keep views or selections of a released array, 
+        as its buffer will be given out again.
+    """
+    
+    def __init__(self, max_free=16, min_size=1024):
+        self.max_free = max_free
+        self.min_size = min_size
+        self._free = []
+        self.hits = 0
+        self.misses = 0
+        
+    def _pool_size(self, size):
+        return max(self.min_size, 1 << int(np.ceil(np.log2(max(size, 1)))))
+        
+    def acquire(self, size=1000, columns=None, compact_precision=False):
+        """Return cleared ParticleArray with rows [0:size] filled with zeros
+        and with given `columns` and `compact_precision` (see ParticleArray)
+        """
+        if columns is None:
+            columns = ParticleArray.data_attributes
+        else:
+            columns = ParticleArray._check_columns(columns)
+        
+        best = None
+        for i, pstack in enumerate(self._free):
+            if (pstack.reserved_size() < size 
+                or pstack.data_attributes != columns
+                or pstack.compact_precision != compact_precision):
+                continue
+            if best is None or pstack.reserved_size() < self._free[best].reserved_size():
+                best = i
+                
+        if best is None:
+            self.misses += 1
+            return ParticleArray(self._pool_size(size), columns=columns, compact_precision=compact_precision)
+        
+        self.hits += 1
+        pstack = self._free.pop(best)
+        pstack._buffer[0:size] = 0
+        return pstack
+    
+    def release(self, pstack):
+        pstack.clear()
+        self._free.append(pstack)
+        if len(self._free) > self.max_free:
+            # Drop the smallest array
+            smallest = min(range(len(self._free)), 
+                           key=lambda i: self._free[i].reserved_size())
+            self._free.pop(smallest)
+    
+    def reserved_size(self):
+        return sum(pstack.reserved_size() for pstack in self._free)
+            
+    def stats(self):
+        return {"hits": self.hits, 
+                "misses": self.misses,
+                "free": len(self._free),
+                "reserved": self.reserved_size()}
+        
+        
+if __name__ == "__main__":
+    pool = ParticleArrayPool()
+    for size in [10, 5000, 10, 3000, 7000]:
+        pstack = pool.acquire(size)
+        pstack.push(pid = np.arange(size), energy = 1e3)
+        print(f"size = {size}, reserved = {pstack.reserved_size()}")
+        pool.release(pstack)
+        
+    print(pool.stats())
@@ -0,0 +1,150 @@
+import time
+
+
+class StageStats:
+    """Accumulated wall time, number of calls and particles of one stage
+    """
+    __slots__ = ("name", "calls", "time", "particles")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.time = 0.0
+        self.particles = 0
+
+    @property
+    def particles_per_second(self):
+        if self.time == 0:
+            return 0.0
+        return self.particles / self.time
+
+    def as_dict(self):
+        return {"calls": self.calls,
+                "time": self.time,
+                "particles": self.particles,
+                "particles_per_second": self.particles_per_second}
+
+
+class _StageContext:
+    __slots__ = ("_stats", "_particles", "_start")
+
+    def __init__(self, stats, particles):
+        self._stats = stats
+        self._particles = particles
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stats = self._stats
+        stats.time += time.perf_counter() - self._start
+        stats.calls += 1
+        stats.particles += self._particles
+        return False
+
+
+class _NoTiming:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_timing = _NoTiming()
+
+
+class StageTimer:
+    """Collect per stage timing of the simulation
+
+    Costs two `time.perf_counter` calls per timed block, so it can stay
+    on in production. Stages are identified by names, nested stages
+    use names like "hadron_interaction.event_generator".
+
+    Example:
+        timer = StageTimer()
+        with timer.stage("filter_by_energy", particles=len(pstack)):
+            ...
+        start = timer.start()
+        ...
+        timer.stop("pythia", start, particles=len(pstack))
+        print(timer.report())
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+
+    def _stats(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = StageStats(name)
+            self.stages[name] = stats
+        return stats
+
+    def stage(self, name, particles=0):
+        """Context manager which times the block as `name`
+        """
+        if not self.enabled:
+            return _no_timing
+        return _StageContext(self._stats(name), particles)
+
+    def start(self):
+        """Start time for `stop`, for places where `with` is inconvenient
+        """
+        return time.perf_counter()
+
+    def stop(self, name, start, particles=0):
+        if not self.enabled:
+            return
+        stats = self._stats(name)
+        stats.time += time.perf_counter() - start
+        stats.calls += 1
+        stats.particles += particles
+
+    def reset(self):
+        self.stages = {}
+
+    def report(self):
+        return PerformanceReport(self.stages)
+
+
+class PerformanceReport:
+    """Snapshot of StageTimer
+
+    `stages` is dictionary name -> {"calls", "time", "particles",
+    "particles_per_second"}. Time is wall time in seconds.
+    """
+    def __init__(self, stages):
+        self.stages = {name: stats.as_dict() for name, stats in stages.items()}
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __contains__(self, name):
+        return name in self.stages
+
+    def as_dict(self):
+        return self.stages
+
+    def merge(self, other):
+        """Add stages of another report (e.g. from another worker)
+        """
+        for name, stats in other.stages.items():
+            if name not in self.stages:
+                self.stages[name] = dict(stats)
+                continue
+            own = self.stages[name]
+            for key in ["calls", "time", "particles"]:
+                own[key] += stats[key]
+            own["particles_per_second"] = (own["particles"] / own["time"]
+                                           if own["time"] > 0 else 0.0)
+        return self
+
+    def __str__(self):
+        lines = [f"{'stage':<40} {'calls':>10} {'time, s':>12} "
+                 f"{'particles':>12} {'particles/s':>12}"]
+        for name, stats in self.stages.items():
+            lines.append(f"{name:<40} {stats['calls']:>10} {stats['time']:>12.4f} "
+                         f"{stats['particles']:>12} {stats['particles_per_second']:>12.4g}")
+        return "\n".join(lines)
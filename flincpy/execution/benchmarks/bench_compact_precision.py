@@ -0,0 +1,67 @@
+"""Validation of compact precision storage of ParticleArray
+
+Compares histograms of final particles (with the binning of 
+CascadeAnalysis.digitize) filled from float64 stack and from 
+the same particles stored in compact (float32) stack.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+import numpy as np
+from data_structs.particle_array import ParticleArray
+
+
+def digitize_bins(max_xdepth):
+    # The same bins as in CascadeAnalysis.digitize
+    xdepth_grid_bins = np.linspace(0.1, max_xdepth + 1, 101)
+    energy_grid_bins = np.geomspace(1e-1, 1e11, 121)
+    return xdepth_grid_bins, energy_grid_bins
+
+
+def compare_histograms(full_stack, compact_stack, max_xdepth):
+    """Return dictionary with precision figures for histograms
+    of `full_stack` and `compact_stack` which should contain the same particles
+    """
+    bins = digitize_bins(max_xdepth)
+    full = full_stack.valid()
+    compact = compact_stack.valid()
+    
+    hist_full = np.histogram2d(full.xdepth, full.energy, bins=bins)[0]
+    hist_compact = np.histogram2d(compact.xdepth.astype(np.float64), 
+                                  compact.energy.astype(np.float64), bins=bins)[0]
+    
+    energy_full = np.sum(full.energy)
+    energy_compact = np.sum(compact.energy, dtype=np.float64)
+    
+    return {"migrated_entries": int(np.sum(np.abs(hist_full - hist_compact))/2),
+            "max_bin_difference": float(np.max(np.abs(hist_full - hist_compact))),
+            "max_rel_energy_error": float(np.max(np.abs(compact.energy - full.energy)/full.energy)),
+            "max_abs_xdepth_error": float(np.max(np.abs(compact.xdepth - full.xdepth))),
+            "total_energy_rel_error": float(abs(energy_compact - energy_full)/energy_full),
+            "bytes_per_particle_full": full_stack._dtype.itemsize,
+            "bytes_per_particle_compact": compact_stack._dtype.itemsize}
+
+
+def synthetic_final_stack(size, max_xdepth, seed=1):
+    rng = np.random.default_rng(seed)
+    stack = ParticleArray(size)
+    stack.push(pid = rng.choice(np.array([-14, -13, -12, 12, 13, 14], dtype=np.int32), size),
+               energy = 10**rng.uniform(-1, 11, size),
+               xdepth = rng.uniform(0, max_xdepth, size),
+               xdepth_stop = max_xdepth,
+               generation_num = rng.integers(0, 30, size),
+               final_code = 1)
+    return stack
+
+
+if __name__ == "__main__":
+    max_xdepth = 1036
+    for size in [10**4, 10**6]:
+        full_stack = synthetic_final_stack(size, max_xdepth)
+        compact_stack = ParticleArray(size, compact_precision=True)
+        compact_stack.append(full_stack)
+        
+        print(f"Number of particles = {size}")
+        for name, value in compare_histograms(full_stack, compact_stack, max_xdepth).items():
+            print(f"  {name} = {value}")
@@ -0,0 +1,85 @@
+"""Interactions per second of HadronInteraction.run_event_generator
+
+"before": kinematics is built and set for every parent (previous implementation),
+"grouped": parents grouped by projectile and energy, cached kinematics,
+"binned N": the same with N energy bins per decade (kinematics of the bin center,
+secondaries rescaled to the parent energy).
+Parents come in several calls (generations). Hit rate of the kinematics
+cache is printed for every mode, the exact ("grouped") mode reuses
+kinematics only for bit-identical energies.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+import time
+import numpy as np
+import chromo
+from data_structs.particle_array import ParticleArray
+from process.hadron_inter import HadronInteraction
+
+
+def synthetic_parents(size, seed=1):
+    rng = np.random.default_rng(seed)
+    parents = ParticleArray(size)
+    parents.push(pid = rng.choice(np.array([2212, 2112, 211, -211, 321, -321], dtype=np.int32), size),
+                 energy = 10**rng.uniform(2, 6, size),
+                 xdepth_inter = rng.uniform(0, 1000, size),
+                 generation_num = np.zeros(size, dtype=np.int32))
+    return parents
+
+
+def run_per_parent(hadron_interaction, parents, children):
+    """Previous implementation: new kinematics for every parent"""
+    pvalid = parents.valid()
+    for i in range(len(pvalid)):
+        try:
+            hadron_interaction.event_generator.kinematics = chromo.kinematics.FixedTarget(
+                pvalid.energy[i], int(pvalid.pid[i]), hadron_interaction.target
+            )
+        except Exception:
+            continue
+        event = next(hadron_interaction.event_generator(1)).final_state()
+        children.push(pid = event.pid, energy = event.en)
+
+
+def interactions_per_second(run, nparents, ngenerations=10):
+    """Parents are processed in `ngenerations` calls, as generations 
+    of a cascade, so the kinematics cache is reused between calls
+    """
+    generations = [synthetic_parents(nparents // ngenerations, seed=seed)
+                   for seed in range(ngenerations)]
+    children = ParticleArray(100 * nparents)
+    start_time = time.perf_counter()
+    for parents in generations:
+        run(parents, children)
+    return nparents / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    nparents = 2000
+    hadron_interaction = HadronInteraction(seed=1)
+
+    results = {}
+    hit_rates = {}
+    results["before"] = interactions_per_second(
+        lambda parents, children: run_per_parent(hadron_interaction, parents, children),
+        nparents)
+
+    for bins_per_decade in [None, 20, 10]:
+        hadron_interaction.energy_bins_per_decade = bins_per_decade
+        hadron_interaction._kinematics_cache.clear()
+        hadron_interaction.kinematics_cache_hits = 0
+        hadron_interaction.kinematics_cache_misses = 0
+        name = "grouped" if bins_per_decade is None else f"binned {bins_per_decade}"
+        results[name] = interactions_per_second(
+            lambda parents, children: hadron_interaction.run_event_generator(parents, children),
+            nparents)
+        hits = hadron_interaction.kinematics_cache_hits
+        hit_rates[name] = hits / max(hits + hadron_interaction.kinematics_cache_misses, 1)
+
+    for name, rate in results.items():
+        line = f"{name:>12}: {rate:10.1f} parents/s, speedup = {rate/results['before']:.2f}"
+        if name in hit_rates:
+            line += f", cache hit rate = {hit_rates[name]:.3f}"
+        print(line)
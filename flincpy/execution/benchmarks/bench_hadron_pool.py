@@ -0,0 +1,38 @@
+"""Interactions per second of HadronInteractionPool vs number of workers
+
+One large generation of parents (as in a high energy shower) is processed
+by HadronInteraction in this process and by pools with 1, 2, 4, ... workers.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+import os
+import time
+from data_structs.particle_array import ParticleArray
+from process.hadron_inter import HadronInteraction
+from process.hadron_pool import HadronInteractionPool
+from bench_hadron_kinematics import synthetic_parents
+
+
+def interactions_per_second(hadron_interaction, nparents):
+    parents = synthetic_parents(nparents)
+    children = ParticleArray(100 * nparents)
+    start_time = time.perf_counter()
+    hadron_interaction.run_event_generator(parents, children)
+    return nparents / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    nparents = 4000
+    serial_rate = interactions_per_second(HadronInteraction(seed=1), nparents)
+    print(f"{'serial':>10}: {serial_rate:10.1f} parents/s")
+
+    nworkers = 1
+    while nworkers <= os.cpu_count():
+        with HadronInteractionPool(nworkers, seed=1) as pool:
+            # Warm up: start workers and initialize DPMJET
+            interactions_per_second(pool, nworkers)
+            rate = interactions_per_second(pool, nparents)
+        print(f"{nworkers:>10}: {rate:10.1f} parents/s, speedup = {rate/serial_rate:.2f}")
+        nworkers *= 2
@@ -0,0 +1,56 @@
+"""Time and memory per shower for history levels of CascadeDriver
+
+Runs the same accumulated showers (the same seed) with
+history = "full", "parents" and "none" and prints loop time per shower
+and bytes of archival and generated stacks per shower.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+import numpy as np
+from cascade.cascade_driver import CascadeDriver
+
+
+def history_bytes(pstack):
+    return len(pstack) * pstack._dtype.itemsize
+
+
+def bench_history(history, nruns, *, pdg = 2212, energy = 1e5,
+                  threshold_energy = 1e0, mceq_decaying_pdgs = [111],
+                  seed = 1, **driver_kwargs):
+    """Return dictionary with time and memory per shower
+    for `nruns` accumulated runs with `history` level
+    """
+    cas_driver = CascadeDriver(0, history = history, seed = seed, **driver_kwargs)
+    cas_driver.simulation_parameters(pdg = pdg,
+                                     energy = energy,
+                                     threshold_energy = threshold_energy,
+                                     mceq_decaying_pdgs = mceq_decaying_pdgs,
+                                     accumulate_runs = True)
+    for _ in range(nruns):
+        cas_driver.run()
+
+    archival_bytes = history_bytes(cas_driver.archival_stack)
+    generated_bytes = history_bytes(cas_driver.generated_stack)
+    return {"time_per_shower_s": cas_driver.loop_execution_time/nruns,
+            "archival_bytes_per_shower": archival_bytes/nruns,
+            "generated_bytes_per_shower": generated_bytes/nruns,
+            "final_particles_per_shower": len(cas_driver.final_stack)/nruns}
+
+
+if __name__ == "__main__":
+    nruns = 100
+    # Warm up (numba compilation, table loading)
+    bench_history("full", 2)
+    
+    results = {}
+    for history in CascadeDriver.history_levels:
+        results[history] = bench_history(history, nruns)
+
+    full = results["full"]
+    for history, result in results.items():
+        print(f"history = {history}")
+        for name, value in result.items():
+            print(f"  {name} = {value:.6g}")
+        print(f"  time relative to full = {result['time_per_shower_s']/full['time_per_shower_s']:.3f}")
@@ -0,0 +1,65 @@
+"""Benchmark of particle_kernels with and without numba
+
+Times one routing step of CascadeDriver.filter_by_slant_depth:
+classification of particles and partition into 4 stacks.
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+import time
+import numpy as np
+from data_structs.particle_array import ParticleArray
+from data_structs import particle_kernels
+
+
+def make_stack(size, rng):
+    stack = ParticleArray(size)
+    stack.push(pid = rng.choice(np.array([-211, 211, 111, 2212, 13, 3122], dtype=np.int32), size),
+               energy = 10**rng.uniform(0, 6, size),
+               xdepth_inter = rng.uniform(0, 1200, size),
+               xdepth_decay = rng.uniform(0, 1200, size))
+    return stack
+
+
+def routing_step(stack, destinations, decay_table):
+    for destination in destinations:
+        destination.clear()
+    wstack = stack.valid()
+    labels = particle_kernels.classify_slant_depth(wstack.xdepth_inter, 
+                                                   wstack.xdepth_decay,
+                                                   wstack.pid, 1000, decay_table)
+    wstack.partition(labels, destinations)
+
+
+def time_step(stack, destinations, decay_table, repeat):
+    routing_step(stack, destinations, decay_table)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        routing_step(stack, destinations, decay_table)
+    return (time.perf_counter() - start)/repeat
+
+
+if __name__ == "__main__":
+    if particle_kernels.numba is None:
+        print("numba is not installed, only numpy kernels are timed")
+        
+    rng = np.random.default_rng(1)
+    decay_table = particle_kernels.PdgTable([3122, 111])
+    
+    print(f"{'particles':>10} {'numpy, us':>12} {'numba, us':>12} {'speedup':>8}")
+    for size in [10**2, 10**3, 10**4, 10**5, 10**6]:
+        stack = make_stack(size, rng)
+        destinations = [ParticleArray(size) for _ in range(4)]
+        repeat = max(10, 10**6 // size)
+        
+        particle_kernels.use_numba = False
+        numpy_time = time_step(stack, destinations, decay_table, repeat)
+        
+        if particle_kernels.numba is not None:
+            particle_kernels.use_numba = True
+            numba_time = time_step(stack, destinations, decay_table, repeat)
+            print(f"{size:>10} {numpy_time*1e6:>12.1f} {numba_time*1e6:>12.1f}"
+                  f" {numpy_time/numba_time:>8.2f}")
+        else:
+            print(f"{size:>10} {numpy_time*1e6:>12.1f}")
@@ -0,0 +1,61 @@
+"""Build the yield library and compare it with live DPMJET
+
+Builds the library (once, if the directory doesn't exist) for nucleons,
+charged pions and kaons on a log energy grid and prints
+interactions per second of HadronInteraction and TabulatedHadronInteraction
+for parents below the library maximal energy.
+
+Usage: python bench_yield_library.py [library_dir]
+"""
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parents[2]))
+
+import time
+import numpy as np
+from data_structs.particle_array import ParticleArray
+from process.hadron_inter import HadronInteraction
+from process.yield_library import build_yield_library, TabulatedHadronInteraction
+
+
+library_pdgs = [2212, -2212, 2112, -2112, 211, -211, 321, -321, 130]
+library_energy_grid = np.geomspace(1e1, 1e4, 31)
+library_events_per_point = 1000
+
+
+def synthetic_parents(size, max_energy, seed=1):
+    rng = np.random.default_rng(seed)
+    parents = ParticleArray(size)
+    parents.push(pid = rng.choice(np.array([2212, 2112, 211, -211, 321, -321], dtype=np.int32), size),
+                 energy = 10**rng.uniform(1.5, np.log10(max_energy), size),
+                 xdepth_inter = rng.uniform(0, 1000, size),
+                 generation_num = np.zeros(size, dtype=np.int32))
+    return parents
+
+
+def interactions_per_second(hadron_interaction, nparents, max_energy):
+    parents = synthetic_parents(nparents, max_energy)
+    children = ParticleArray(100 * nparents)
+    start_time = time.perf_counter()
+    hadron_interaction.run_event_generator(parents, children)
+    return nparents / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    library_path = Path(sys.argv[1] if len(sys.argv) > 1 else "yield_library")
+    hadron_interaction = HadronInteraction(seed=1)
+
+    if not library_path.exists():
+        start_time = time.perf_counter()
+        build_yield_library(library_path, library_pdgs, library_energy_grid,
+                            library_events_per_point, hadron_interaction=hadron_interaction)
+        print(f"Library is built in {time.perf_counter() - start_time:.1f} s")
+
+    max_energy = library_energy_grid[-1]
+    tabulated = TabulatedHadronInteraction(library_path, fallback=hadron_interaction, seed=1)
+
+    nparents = 2000
+    live_rate = interactions_per_second(hadron_interaction, nparents, max_energy)
+    tabulated_rate = interactions_per_second(tabulated, nparents, max_energy)
+    print(f"{'dpmjet':>10}: {live_rate:12.1f} parents/s")
+    print(f"{'library':>10}: {tabulated_rate:12.1f} parents/s, speedup = {tabulated_rate/live_rate:.1f}")
@@ -3,28 +3,67 @@ import numpy as np
 from pathlib import Path
 from data_structs.particle_array import ParticleArray, FilterCode
 from data_structs.pdg_pid_map import PdgLists
+from data_structs.particle_pool import ParticleArrayPool
+from process.seeds import generator_seed
+from data_structs.stage_timer import StageTimer
+from process.engine_result import EngineResult, EngineStatus
 
 chormo_path = Path(chromo.__file__).parent
 
 
 class DecayDriver:
-    def __init__(self, xdepth_getter, decaying_pdgs = None, stable_pdgs=None):
+    # Columns of ParticleArray used by the driver
+    required_columns = ["pid",
+                        "energy",
+                        "xdepth",
+                        "xdepth_stop",
+                        "generation_num",
+                        "xdepth_decay",
+                        "final_code",
+                        "filter_code",
+                        "id",
+                        "parent_id",
+                        "shower_id",
+                        "weight"]
+    
+    def __init__(self, xdepth_getter, decaying_pdgs = None, stable_pdgs=None, 
+                 particle_pool=None, seed=None, timer=None):
+        """
+        Args:
+            seed (int or np.random.SeedSequence): seed of Pythia random 
+                generator, random if None
+            timer (StageTimer): collects time of Pythia calls
+        """
+        if timer is None:
+            timer = StageTimer()
+        self.timer = timer
         self._xdepth_getter = xdepth_getter
+        if particle_pool is None:
+            particle_pool = ParticleArrayPool()
+        self._particle_pool = particle_pool
         self._decaying_pdgs = decaying_pdgs
         self._stable_pdgs = stable_pdgs
+        self._seed = generator_seed(seed)
+        self._init_pythia()
+        
+    def set_seed(self, seed):
+        """Reinitialize Pythia with new seed (int or np.random.SeedSequence)
+        
+        State of Pythia random generator can't be saved, so 
+        after restore it is continued with a new seed
+        """
+        self._seed = generator_seed(seed)
         self._init_pythia()
         
     def _init_pythia(self):
         import importlib
-        from random import randint
 
         lib = importlib.import_module(f"chromo.models._pythia8")
         xml_path = chormo_path / "iamdata/Pythia8/xmldoc"
         self._pythia = lib.Pythia(str(xml_path), False)
-        seed = randint(1, 10000000)
         self._pythia.settings.resetAll()
         self._pythia.readString("Random:setSeed = on")
-        self._pythia.readString(f"Random:seed = {seed}")
+        self._pythia.readString(f"Random:seed = {self._seed}")
         self._pythia.readString("Print:quiet = on")
         self._pythia.readString("ProcessLevel:all = off")
         self._pythia.readString("ParticleDecays:tau0Max = 1e100")
@@ -58,10 +97,10 @@ class DecayDriver:
             pstack (ParticleArray): array of particle which need to set xdepth_decay
         """
         slice_to_fill = np.where(pstack.valid().filter_code != FilterCode.XD_DECAY_ON.value)[0]
-        # stack_to_fill is a copy, because of advanced indexing in numpy
+        # stack_to_fill is a selection, values set by xdepth_getter
+        # are written directly to pstack
         stack_to_fill = pstack[slice_to_fill]
         self._xdepth_getter.get_decay_xdepth(stack_to_fill)
-        pstack[slice_to_fill] = stack_to_fill
     
     
     def _fill_xdepth_for_decay_chain(self, pstack, parents, zero_generation_length):
@@ -74,6 +113,10 @@ class DecayDriver:
             `pstack` (ParticleArray): array to fill
             `parents` (np.array): parent information
             `zero_generation_length` (int): length of 0th generation particles (the ones that decayed)
+        
+        Returns:
+            (np.array, np.array): rows of the 1st generation 
+            and rows of their parents
         """
         # parent_indices contains 0-based indices in pstack arrays
         # The last element is introduced for the indicies == -1
@@ -114,17 +157,19 @@ class DecayDriver:
         pstack.generation_num[generation_slice] = pstack.generation_num[parent_indices[generation_slice]] + 1
         pstack.parent_id[generation_slice] = pstack.id[parent_indices[generation_slice]]
         pstack.final_code[generation_slice] = pstack.final_code[parent_indices[generation_slice]]
+        pstack.shower_id[generation_slice] = pstack.shower_id[parent_indices[generation_slice]]
+        pstack.weight[generation_slice] = pstack.weight[parent_indices[generation_slice]]
         # Set filter code to fill it in "set_xdepth_code()""
         pstack.filter_code[generation_slice] = FilterCode.XD_DECAY_OFF.value
         self._set_xdepth_decay(pstack)
         # parent_gen points to parents of parents ...
         parent_gen = parent_indices[parent_gen]
         
-        return generation_slice
+        return generation_slice, parent_indices[generation_slice]
 
             
         
-    def run_decay(self, pstack, decayed_particles, stable_particles):
+    def run_decay(self, pstack, decayed_particles, stable_particles=None):
         """Run decay of particle in pstack
                 
         FilterCode.XD_DECAY_OFF.value for `filter_code` should be set for particles 
@@ -133,11 +178,19 @@ class DecayDriver:
 
         Args:
             pstack (ParticleArray): stack with decaying particles
+            decayed_particles (ParticleArray): decay products are appended to it
+            stable_particles (ParticleArray): if given, particles of pstack 
+                which didn't decay are appended to it
+        
+        Returns:
+            EngineResult: status of every particle of pstack 
+            and parent row of every decay product
         """
         
         # Set xdepth_decay for particles which doesn't have it
         self._set_xdepth_decay(pstack)   
         # Fill the Pythia stack of particles that should decay
+        start = self.timer.start()
         self._pythia.event.reset()
         for ip in range(len(pstack)):
             m0 = self._pythia.particleData.findParticle(pstack.pid[ip]).m0
@@ -155,11 +208,15 @@ class DecayDriver:
 
         # Decay it
         self._pythia.forceHadronLevel()
+        self.timer.stop("decay_driver.pythia", start, particles=len(pstack))
         
         # number_of_decays = len(np.where(self._pythia.event.status() == 2)[0])
         # Process event from Pythia
-        decay_stack = ParticleArray()
-        decay_stack.push(pid = self._pythia.event.pid(),
+        event_pid = self._pythia.event.pid()
+        decay_stack = self._particle_pool.acquire(len(event_pid), 
+                                                  columns=decayed_particles.data_attributes,
+                                                  compact_precision=decayed_particles.compact_precision)
+        decay_stack.push(pid = event_pid,
                        energy = self._pythia.event.en())
         
         # Set 0th generation
@@ -173,6 +230,8 @@ class DecayDriver:
         dsv.generation_num[gen0_slice] = pstack.valid().generation_num
         dsv.filter_code[gen0_slice] = pstack.valid().filter_code
         dsv.final_code[gen0_slice] = pstack.valid().final_code
+        dsv.shower_id[gen0_slice] = pstack.valid().shower_id
+        dsv.weight[gen0_slice] = pstack.valid().weight
         
         # Get parents array and fill in rest generations
         parents = self._pythia.event.parents()[:,0]
@@ -182,7 +241,8 @@ class DecayDriver:
         # print(f"PDG = {self._pythia.event.pid()}")
         # print(f"Energy = {self._pythia.event.en()}")
              
-        first_generation_slice = self._fill_xdepth_for_decay_chain(decay_stack, parents, len(pstack))
+        first_generation_slice, parent_rows = self._fill_xdepth_for_decay_chain(decay_stack, 
+                                                                                parents, len(pstack))
         # Filter final particles
         fin_status = self._pythia.event.status() == 1
         decayed_slice = fin_status[gen0_slice]
@@ -194,9 +254,14 @@ class DecayDriver:
         # stable_particles = decay_stack[np.where(decayed_slice)]
         
         decayed_particles.append(decay_stack[first_generation_slice])
-        stable_particles.append(decay_stack[np.where(decayed_slice)])
+        if stable_particles is not None:
+            stable_particles.append(decay_stack[np.where(decayed_slice)])
+        self._particle_pool.release(decay_stack)
         
-        return number_of_decays
+        status = np.where(decayed_slice, 
+                          EngineStatus.REJECTED.value, 
+                          EngineStatus.PROCESSED.value).astype(np.int8)
+        return EngineResult(status, parent_rows.astype(np.int64), number_of_decays)
         
 
 if __name__ == "__main__":
@@ -223,8 +288,9 @@ if __name__ == "__main__":
     
     final_particles = ParticleArray()
     stable_particles = ParticleArray()
-    number_of_decays = decay_driver.run_decay(pstack, final_particles=final_particles, 
-                                              stable_particles=stable_particles)
+    result = decay_driver.run_decay(pstack, decayed_particles=final_particles, 
+                                    stable_particles=stable_particles)
+    number_of_decays = result.number_of_events
     fstack = final_particles.valid()
     print("pid = ", fstack.pid)
     print("energy = ", fstack.energy)
@@ -0,0 +1,52 @@
+import numpy as np
+from enum import Enum
+
+
+class EngineStatus(Enum):
+    # Parent was returned unchanged (interaction or decay is not possible)
+    REJECTED = 0
+    # Parent interacted or decayed
+    PROCESSED = 1
+
+
+class EngineResult:
+    """Result of HadronInteraction.run_event_generator and DecayDriver.run_decay
+    
+    Args:
+        status (np.array): EngineStatus values (int8) aligned with 
+            valid rows of the input parents
+        parent_rows (np.array): row of the parent in the input parents 
+            for every child appended to the output stack by the call
+        number_of_events (int): number of interactions or decays
+    """
+    def __init__(self, status, parent_rows, number_of_events):
+        self.status = status
+        self.parent_rows = parent_rows
+        self.number_of_events = number_of_events
+    
+    def processed(self):
+        """Mask of parents which interacted or decayed
+        """
+        return self.status == EngineStatus.PROCESSED.value
+    
+    def rejected(self):
+        """Mask of parents returned unchanged
+        """
+        return self.status == EngineStatus.REJECTED.value
+    
+    def child_offsets(self):
+        """Children grouped by parent
+        
+        Engines append children in their own order (e.g. by projectile 
+        and energy, or by model), not by parent row, so children are 
+        grouped with a stable sort of `parent_rows`.
+        
+        Returns:
+            (order, offsets): children of parent `i` are appended rows 
+                `order[offsets[i]:offsets[i+1]]` in the order of appending
+        """
+        order = np.argsort(self.parent_rows, kind="stable")
+        counts = np.bincount(self.parent_rows, minlength=len(self.status))
+        offsets = np.zeros(len(self.status) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return order, offsets
@@ -1,16 +1,60 @@
 import chromo
 from data_structs.particle_array import ParticleArray
 import numpy as np
+from process.seeds import generator_seed
+from data_structs.stage_timer import StageTimer
+from process.engine_result import EngineResult, EngineStatus
 
 
 class HadronInteraction:
-    def __init__(self):
+    # Columns of ParticleArray used by the event generator
+    required_columns = ["pid",
+                        "energy",
+                        "generation_num",
+                        "xdepth_inter",
+                        "production_code",
+                        "id",
+                        "parent_id",
+                        "shower_id",
+                        "weight"]
+    
+    def __init__(self, seed=None, timer=None, energy_bins_per_decade=None,
+                 kinematics_cache_size=4096, model="DpmjetIII191"):
+        """
+        Args:
+            seed (int or np.random.SeedSequence): seed of the event generator,
+                random if None
+            timer (StageTimer): collects time of event generator calls
+            energy_bins_per_decade (int): if given, parents in the same 
+                log10 energy bin are generated with the kinematics of the bin 
+                center and kinetic energies of secondaries are rescaled 
+                to the parent energy (if the bin center is below the generator
+                threshold, parents use their own energies). It trades precision for speed, 
+                None (exact parent energies) by default. In the exact mode 
+                kinematics is reused only by parents with bit-identical energies
+                (e.g. copies of the same primary), which practically never happens 
+                in a cascade, so the cache gives no speedup there, 
+                see `kinematics_cache_hits` and `kinematics_cache_misses`
+            kinematics_cache_size (int): maximal number of cached 
+                (projectile, energy) kinematics
+            model (str or class): chromo model, name in `chromo.models` 
+                (e.g. "DpmjetIII191", "Sibyll23d", "EposLHC") or the class
+        """
+        if timer is None:
+            timer = StageTimer()
+        self.timer = timer
+        self.energy_bins_per_decade = energy_bins_per_decade
+        self.kinematics_cache_size = kinematics_cache_size
+        self._kinematics_cache = {}
+        self.kinematics_cache_hits = 0
+        self.kinematics_cache_misses = 0
         self.target = chromo.kinematics.CompositeTarget([("N", 0.78), ("O", 0.22)])
         # self.target = (14, 7)
         ekin = chromo.kinematics.FixedTarget(20000, "proton", self.target)
-        self.event_generator = chromo.models.DpmjetIII191(ekin)
-        # self.event_generator = chromo.models.EposLHC(ekin)
-        # self.event_generator = chromo.models.Sibyll23d(ekin)
+        if isinstance(model, str):
+            model = getattr(chromo.models, model)
+        self.model = model
+        self.event_generator = model(ekin, seed=generator_seed(seed))
         # self.event_generator._ecm_min = 2 # GeV
         # chromo.models.Sibyll23d(ekin)
         # self.event_generator.set_unstable(111)
@@ -18,74 +62,184 @@ class HadronInteraction:
         # self.event_generator.set_unstable(211)
     
     
-    def run_event_generator(self, parents, children, failed_parents):
+    def get_random_state(self):
+        """State of event generator random numbers (json serializable dict)
+        """
+        return self.event_generator.random_state
+    
+    def set_random_state(self, random_state):
+        self.event_generator.random_state = random_state
+    
+    def run_event_generator(self, parents, children, failed_parents=None):
+        """Run event generator for valid particles of `parents` 
+        and append secondaries to `children`
+        
+        Parents are grouped by projectile and, within the group, by energy
+        (or energy bin, see `energy_bins_per_decade`), so the generator 
+        kinematics changes once per group of parents with the same kinematics,
+        and all events of the group are generated in one generator call.
         
+        `production_code` of parents is set to 0 if the parent interacted,
+        otherwise to the reason of failure (111: projectile is not allowed,
+        222: too low center-of-mass energy, 333: other)
+        
+        Args:
+            parents (ParticleArray): interacting particles
+            children (ParticleArray): secondaries are appended to it
+            failed_parents (ParticleArray): if given, parents which didn't 
+                interact are appended to it
+        
+        Returns:
+            EngineResult: status of every parent and parent row of every child
+        """
         number_of_interactions = 0
         pvalid = parents.valid()
         pvalid.production_code[:] = 0
+        parent_rows = []
         
-        for i in range(len(pvalid)):
-            try:
-                self.event_generator.kinematics = chromo.kinematics.FixedTarget(
-                    pvalid.energy[i], int(pvalid.pid[i]), self.target
-                )
+        groups = pvalid.group_by("pid")
+        for pid, segment in zip(groups.keys, groups.segments()):
+            pid = int(pid)
+            rows = groups.order[segment]
+            kin_energy = self._kinematics_energy(pvalid.energy[rows])
+            # Parents with the same kinematics become consecutive
+            energy_order = np.argsort(kin_energy, kind="stable")
+            rows = rows[energy_order]
+            kin_energy = kin_energy[energy_order]
+            starts = np.flatnonzero(np.concatenate(([True], kin_energy[1:] != kin_energy[:-1])))
+            ends = np.append(starts[1:], len(rows))
+            
+            for start, end in zip(starts, ends):
+                kin_rows = rows[start:end]
+                code = self.set_kinematics(pid, kin_energy[start])
+                if code == 111:
+                    # projectile is not allowed, the whole group fails
+                    pvalid.production_code[rows[start:]] = code
+                    break
+                if code > 0 and self.energy_bins_per_decade is not None:
+                    # Bin center is below the generator threshold,
+                    # parents of the bin are tried with their own energies
+                    for i in kin_rows:
+                        code = self.set_kinematics(pid, pvalid.energy[i])
+                        if code > 0:
+                            pvalid.production_code[i] = code
+                            continue
+                        number_of_interactions += self._generate(
+                            np.array([i]), pvalid.energy[i], 
+                            pvalid, children, parent_rows)
+                    continue
+                if code > 0:
+                    pvalid.production_code[kin_rows] = code
+                    continue
                 
-                if (self.event_generator.kinematics.ekin <= 2e0):
+                number_of_interactions += self._generate(kin_rows, kin_energy[start], 
+                                                         pvalid, children, parent_rows)
+            
+            # print("\n")
+            # print(f"event.pid = {event.pid}")
+            # print(f"event.pid = {event.en},\nsum = {np.sum(event.en)}, init = {pvalid.energy[i]}")
+            # print(f"event.pid = {event.status}")
+            # print(self.event_generator.kinematics)
+            # print(f"Interaction: energy conservation {100*(np.sum(event.en) - pvalid.energy[i])/pvalid.energy[i]} %\n")
+        
+        status = np.where(pvalid.production_code == 0, 
+                          EngineStatus.PROCESSED.value, 
+                          EngineStatus.REJECTED.value).astype(np.int8)
+        if failed_parents is not None:
+            failed_parents.append(pvalid[np.where(status == EngineStatus.REJECTED.value)[0]])
+        
+        if len(parent_rows) > 0:
+            parent_rows = np.concatenate(parent_rows)
+        else:
+            parent_rows = np.empty(0, dtype=np.int64)
+        return EngineResult(status, parent_rows, number_of_interactions)
+    
+    def _generate(self, rows, kin_energy, pvalid, children, parent_rows):
+        """Generate one event with the current kinematics (`kin_energy`)
+        for every parent in `rows` of `pvalid`, push secondaries to `children`
+        and their parent rows to the list `parent_rows`
+        
+        Returns:
+            int: number of events
+        """
+        start_time = self.timer.start()
+        events = [event.final_state() for event in self.event_generator(len(rows))]
+        self.timer.stop("hadron_interaction.event_generator", start_time, 
+                        particles=len(rows))
+        
+        for i, event in zip(rows, events):
+            energy = event.en
+            ratio = pvalid.energy[i] / kin_energy
+            if ratio != 1:
+                # Rescale kinetic energy from bin energy to parent energy,
+                # so secondaries stay above their masses
+                energy = event.m + (energy - event.m) * ratio
+            
+            children.push(pid = event.pid, 
+                            energy = energy, 
+                            xdepth = pvalid.xdepth_inter[i],
+                            generation_num = pvalid.generation_num[i] + 1,
+                            parent_id = pvalid.id[i],
+                            shower_id = pvalid.shower_id[i],
+                            weight = pvalid.weight[i],
+                            production_code = 777)
+            parent_rows.append(np.full(len(event.pid), i, dtype=np.int64))
+        return len(events)
+    
+    def _kinematics_energy(self, energy):
+        """Energy for generator kinematics: parent energy
+        or the log center of its bin
+        """
+        if self.energy_bins_per_decade is None:
+            return energy.astype(np.float64)
+        
+        bins_per_decade = self.energy_bins_per_decade
+        ibin = np.floor(np.log10(energy) * bins_per_decade)
+        return 10 ** ((ibin + 0.5) / bins_per_decade)
+    
+    def set_kinematics(self, pid, energy):
+        """Set generator kinematics for projectile `pid` with `energy`
+        
+        Kinematics objects (or failure codes) are cached by (pid, energy), 
+        the generator is updated only if its kinematics is different.
+        
+        Returns:
+            int: 0 if kinematics is set, otherwise production code of failure
+        """
+        key = (pid, float(energy))
+        kinematics = self._kinematics_cache.get(key)
+        
+        if kinematics is None:
+            self.kinematics_cache_misses += 1
+            if len(self._kinematics_cache) >= self.kinematics_cache_size:
+                self._kinematics_cache.clear()
+            
+            try:
+                kinematics = chromo.kinematics.FixedTarget(energy, pid, self.target)
+                if (kinematics.ekin <= 2e0):
                     raise RuntimeError("Too low energy")
                 
+                self.event_generator.kinematics = kinematics
             except Exception as e:
                 if "projectile" in str(e):
                     # projectile is not allowed
-                    pvalid.production_code[i] = 111
+                    kinematics = 111
                 elif "center-of-mass" in str(e):
                     # center-of-mass energy  < minimum energy 10.0 GeV
-                    pvalid.production_code[i] = 222
+                    kinematics = 222
                 else:
-                    pvalid.production_code[i] = 333
-                
-                continue    
-            
-            
-            event = next(self.event_generator(1)).final_state()
-            # try:        
-            #     event = next(self.event_generator(1)).final_state()
-            # except RuntimeError as er:
-            #     pvalid.production_code[i] = 333
-            #     continue
-                # print(er)
-                # print(f"pdg_proj = {self.event_generator.kinematics.p1}" 
-                #       f" and energy = {self.event_generator.kinematics.elab}")
-                # print(self.event_generator.kinematics)   
-                
-            number_of_interactions += 1
-            generation_num = pvalid.generation_num[i] + 1
+                    kinematics = 333
             
-            # if len(np.where(event.pid == 8)[0]) > 0:
-            #     print(f"event.pid = {event.pid}")
-            #     print(f"event.status = {event.status}")
-            #     print(f"pdg_proj = {self.event_generator.kinematics.p1}" 
-            #           f" and energy = {self.event_generator.kinematics.elab}")
-            #     print(self.event_generator.kinematics) 
-            #     self.event_generator._lib.dt_evtout(6)
-            #     print("Here STOP")
-            
-            children.push(pid = event.pid, 
-                            energy = event.en, 
-                            xdepth = pvalid.xdepth_inter[i],
-                            generation_num = generation_num,
-                            parent_id = pvalid.id[i],
-                            production_code = 777)
-            
-            # print("\n")
-            # print(f"event.pid = {event.pid}")
-            # print(f"event.pid = {event.en},\nsum = {np.sum(event.en)}, init = {pvalid.energy[i]}")
-            # print(f"event.pid = {event.status}")
-            # print(self.event_generator.kinematics)
-            # print(f"Interaction: energy conservation {100*(np.sum(event.en) - pvalid.energy[i])/pvalid.energy[i]} %\n")
+            self._kinematics_cache[key] = kinematics
+            return kinematics if isinstance(kinematics, int) else 0
         
-        failed_parents.append(pvalid[np.where(pvalid.production_code > 0)])
+        self.kinematics_cache_hits += 1
+        if isinstance(kinematics, int):
+            return kinematics
         
-        return number_of_interactions
+        if self.event_generator.kinematics is not kinematics:
+            self.event_generator.kinematics = kinematics
+        return 0
         
 
 if __name__ == "__main__":
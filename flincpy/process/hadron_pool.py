@@ -0,0 +1,320 @@
+import multiprocessing
+import queue
+import traceback
+import weakref
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+from data_structs.particle_array import ParticleArray
+from data_structs.stage_timer import StageTimer
+from process.hadron_inter import HadronInteraction
+from process.engine_result import EngineResult, EngineStatus
+
+
+# Columns of children filled by HadronInteraction.run_event_generator
+child_columns = ["pid",
+                 "energy",
+                 "xdepth",
+                 "generation_num",
+                 "production_code",
+                 "parent_id",
+                 "shower_id",
+                 "weight"]
+
+
+def _row_dtype(columns):
+    return ParticleArray(0, columns=columns)._dtype
+
+
+def _bind_rows(shm, dtype, size, offset=0):
+    return np.ndarray(size, dtype=dtype, buffer=shm.buf, offset=offset)
+
+
+def _hadron_worker(seed, hadron_kwargs, tasks, results):
+    """Loop of worker process: run HadronInteraction for parent batches
+    in shared memory and write children back to shared memory
+
+    Messages from `tasks` and answers to `results`:
+        ("run", input_name, nparents, output_name, output_size) ->
+            ("done", nchildren, status, number_of_events), or ("grow", size)
+            answered with ("output", output_name, output_size) first
+        ("get_random_state",) -> ("state", random_state)
+        ("set_random_state", state) -> ("state_set",)
+        ("stop",) -> no answer
+    Exceptions are sent as ("error", traceback) instead of the answer.
+    """
+    try:
+        hadron_interaction = HadronInteraction(seed=seed, **hadron_kwargs)
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+        return
+    parent_dtype = _row_dtype(HadronInteraction.required_columns)
+    buffers = {}
+
+    def attach(name):
+        if name not in buffers:
+            buffers[name] = shared_memory.SharedMemory(name=name)
+        return buffers[name]
+
+    def release(keep):
+        for name in list(buffers):
+            if name not in keep:
+                buffers.pop(name).close()
+
+    def run(input_name, nparents, output_name, output_size):
+        release([input_name, output_name])
+        # Parents are used in place, production codes go back the same way
+        parents = ParticleArray(None, columns=HadronInteraction.required_columns)
+        parents._bind(_bind_rows(attach(input_name), parent_dtype, nparents))
+        parents._len = nparents
+        parents.data = parents
+
+        children.clear()
+        result = hadron_interaction.run_event_generator(parents, children)
+        nchildren = len(children)
+        required_size = nchildren * (children._dtype.itemsize + 8)
+        if required_size > output_size:
+            results.put(("grow", required_size))
+            _, output_name, output_size = tasks.get()
+            release([input_name, output_name])
+
+        output = attach(output_name)
+        _bind_rows(output, children._dtype, nchildren)[:] = children._rows()
+        _bind_rows(output, np.int64, nchildren,
+                   offset=nchildren * children._dtype.itemsize)[:] = result.parent_rows
+        return ("done", nchildren, result.status, result.number_of_events)
+
+    children = ParticleArray(columns=child_columns)
+    while True:
+        task = tasks.get()
+        command = task[0]
+        if command == "stop":
+            break
+
+        try:
+            if command == "get_random_state":
+                answer = ("state", hadron_interaction.get_random_state())
+            elif command == "set_random_state":
+                hadron_interaction.set_random_state(task[1])
+                answer = ("state_set",)
+            else:
+                # Views of shared memory live only inside `run`
+                answer = run(*task[1:])
+        except Exception:
+            answer = ("error", traceback.format_exc())
+        results.put(answer)
+
+    release([])
+
+
+def _shutdown(workers, buffers):
+    for process, tasks, _ in workers:
+        if process.is_alive():
+            tasks.put(("stop",))
+    for process, _, _ in workers:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    for shm in buffers.values():
+        try:
+            shm.close()
+        except BufferError:
+            # A view is still alive (e.g. in a traceback),
+            # the mapping is released with it
+            pass
+        shm.unlink()
+    workers.clear()
+    buffers.clear()
+
+
+class HadronInteractionPool:
+    """HadronInteraction in worker processes
+
+    Every worker owns a HadronInteraction (its own DPMJET instance) seeded
+    from its own child of `seed`. Valid parents are split into one
+    contiguous batch per worker, batches are written to shared memory,
+    and workers write children rows and parent rows back to shared memory,
+    so only small messages are pickled. Results are reproducible for
+    the same `seed` and `nworkers`.
+
+    The interface is the same as of HadronInteraction. Workers are started
+    at the first call and stopped by `close` (or when the pool is deleted).
+    If a worker raises or exits, the pool is closed and RuntimeError
+    with the worker traceback is raised, as the exception of
+    HadronInteraction in this process would be.
+    """
+    required_columns = HadronInteraction.required_columns
+
+    # Interval of checks that a worker is alive while waiting for it, s
+    poll_interval = 1.0
+
+    def __init__(self, nworkers=None, seed=None, timer=None, min_batch_size=16,
+                 start_method="spawn", timeout=None, **hadron_kwargs):
+        """
+        Args:
+            nworkers (int): number of worker processes, number of CPUs if None
+            seed (int or np.random.SeedSequence): root of worker seeds
+            timer (StageTimer): collects time of pool calls
+            min_batch_size (int): smaller generations use fewer workers
+            start_method (str): multiprocessing start method
+            timeout (float): maximal time to wait for an answer of a worker
+                in seconds, no limit if None
+            hadron_kwargs: arguments of HadronInteraction in workers
+        """
+        self.nworkers = nworkers or multiprocessing.cpu_count()
+        self.seed_sequence = seed
+        if not isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = np.random.SeedSequence(seed)
+        if timer is None:
+            timer = StageTimer()
+        self.timer = timer
+        self.min_batch_size = min_batch_size
+        self.start_method = start_method
+        self.timeout = timeout
+        self.hadron_kwargs = hadron_kwargs
+
+        self._parent_dtype = _row_dtype(self.required_columns)
+        self._workers = []
+        # Shared memory owned by the pool: "input<i>" and "output<i>" per worker
+        self._buffers = {}
+        self._finalizer = weakref.finalize(self, _shutdown, self._workers, self._buffers)
+
+    def start(self):
+        if self._workers:
+            return
+        # Workers share the tracker of this process, so shared memory
+        # attached by workers is not unlinked when a worker exits
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context(self.start_method)
+        for seed in self.seed_sequence.spawn(self.nworkers):
+            tasks, results = context.Queue(), context.Queue()
+            process = context.Process(target=_hadron_worker,
+                                      args=(seed, self.hadron_kwargs, tasks, results),
+                                      daemon=True)
+            process.start()
+            self._workers.append((process, tasks, results))
+
+    def close(self):
+        self._finalizer()
+        self._finalizer = weakref.finalize(self, _shutdown, self._workers, self._buffers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def _buffer(self, key, size):
+        """Shared memory of at least `size` bytes, reallocated when too small
+        """
+        shm = self._buffers.get(key)
+        if shm is None or shm.size < size:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = shared_memory.SharedMemory(create=True, size=max(2 * size, 4096))
+            self._buffers[key] = shm
+        return shm
+
+    def _receive(self, i):
+        """Next answer of worker `i`
+
+        Raises:
+            RuntimeError: if the worker sent an error, exited or timed out
+        """
+        process, _, results = self._workers[i]
+        waited = 0.0
+        while True:
+            try:
+                message = results.get(timeout=self.poll_interval)
+                break
+            except queue.Empty:
+                waited += self.poll_interval
+                if not process.is_alive():
+                    error = f"Hadron worker {i} exited with code {process.exitcode}"
+                elif self.timeout is not None and waited >= self.timeout:
+                    error = f"Hadron worker {i} didn't answer in {self.timeout} s"
+                else:
+                    continue
+            self.close()
+            raise RuntimeError(error)
+
+        if message[0] == "error":
+            self.close()
+            raise RuntimeError(f"Hadron worker {i} failed:\n{message[1]}")
+        return message
+
+    def get_random_state(self):
+        """Random states of all workers (json serializable list)
+        """
+        self.start()
+        for _, tasks, _ in self._workers:
+            tasks.put(("get_random_state",))
+        return [self._receive(i)[1] for i in range(len(self._workers))]
+
+    def set_random_state(self, random_state):
+        self.start()
+        for (_, tasks, _), state in zip(self._workers, random_state):
+            tasks.put(("set_random_state", state))
+        for i in range(len(self._workers)):
+            self._receive(i)
+
+    def run_event_generator(self, parents, children, failed_parents=None):
+        """Run event generators of workers for valid particles of `parents`
+        and append secondaries to `children`, see HadronInteraction.run_event_generator
+        """
+        self.start()
+        pvalid = parents.valid()
+        nparents = len(pvalid)
+        start_time = self.timer.start()
+
+        nbatches = min(self.nworkers, max(1, -(-nparents // self.min_batch_size)))
+        bounds = np.linspace(0, nparents, nbatches + 1).astype(np.int64)
+        batches = []
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            if start == end:
+                continue
+            _, tasks, _ = self._workers[i]
+            input_shm = self._buffer(f"input{i}", (end - start) * self._parent_dtype.itemsize)
+            batch_rows = _bind_rows(input_shm, self._parent_dtype, end - start)
+            batch_rows[:] = 0
+            for attr in self.required_columns:
+                batch_rows[attr] = getattr(pvalid, attr)[start:end]
+            output_shm = self._buffers.get(f"output{i}")
+            if output_shm is None:
+                output_shm = self._buffer(f"output{i}", 0)
+            tasks.put(("run", input_shm.name, end - start, output_shm.name, output_shm.size))
+            batches.append((i, start, end, batch_rows))
+
+        status = np.full(nparents, EngineStatus.REJECTED.value, dtype=np.int8)
+        parent_rows = []
+        number_of_interactions = 0
+        child_dtype = _row_dtype(child_columns)
+        for i, start, end, batch_rows in batches:
+            _, tasks, _ = self._workers[i]
+            message = self._receive(i)
+            if message[0] == "grow":
+                output_shm = self._buffer(f"output{i}", message[1])
+                tasks.put(("output", output_shm.name, output_shm.size))
+                message = self._receive(i)
+
+            _, nchildren, batch_status, number_of_events = message
+            output_shm = self._buffers[f"output{i}"]
+            children._append_rows(_bind_rows(output_shm, child_dtype, nchildren))
+            parent_rows.append(start + _bind_rows(output_shm, np.int64, nchildren,
+                                                  offset=nchildren * child_dtype.itemsize))
+            pvalid.production_code[start:end] = batch_rows["production_code"]
+            status[start:end] = batch_status
+            number_of_interactions += number_of_events
+
+        self.timer.stop("hadron_interaction.pool", start_time, particles=nparents)
+
+        if failed_parents is not None:
+            failed_parents.append(pvalid[np.where(status == EngineStatus.REJECTED.value)[0]])
+
+        if len(parent_rows) > 0:
+            parent_rows = np.concatenate(parent_rows)
+        else:
+            parent_rows = np.empty(0, dtype=np.int64)
+        return EngineResult(status, parent_rows, number_of_interactions)
@@ -0,0 +1,143 @@
+import numpy as np
+
+from data_structs.stage_timer import StageTimer
+from process.hadron_inter import HadronInteraction
+from process.engine_result import EngineResult, EngineStatus
+
+
+class HybridHadronInteraction:
+    """Hadron interactions with the model chosen by projectile and energy
+
+    Every band is a tuple (model, min_energy, max_energy) or
+    (model, min_energy, max_energy, pdgs), where `model` is a name
+    in `chromo.models` or a model class (bands keep its name), energies are in GeV (min inclusive, max exclusive,
+    None for no limit) and `pdgs` restricts the band to these projectiles.
+    A parent goes to the model of the first band which contains it,
+    parents outside all bands are rejected with production code 111.
+
+    A HadronInteraction is created for a model at its first parent,
+    so models which are never used are not initialized.
+    Time of every model is in the stage "hadron_interaction.<model>"
+    of `timer`, number of parents and interactions in `model_counters`.
+
+    Example:
+        HybridHadronInteraction.crossover(1e3, "DpmjetIII191", "Sibyll23d")
+    """
+    required_columns = HadronInteraction.required_columns
+
+    def __init__(self, bands, seed=None, timer=None, **hadron_kwargs):
+        """
+        Args:
+            bands (list): model bands, see the class description
+            seed (int or np.random.SeedSequence): root of model seeds
+            timer (StageTimer): collects time per model
+            hadron_kwargs: other arguments of HadronInteraction
+        """
+        # Classes of models given as classes, by name
+        self._model_classes = {}
+        self.bands = [self._check_band(band) for band in bands]
+        # Models in the order of the first appearance,
+        # every model gets a seed by its position
+        self.models = list(dict.fromkeys(band[0] for band in self.bands))
+        seed_sequence = seed
+        if not isinstance(seed, np.random.SeedSequence):
+            seed_sequence = np.random.SeedSequence(seed)
+        self._model_seeds = dict(zip(self.models, seed_sequence.spawn(len(self.models))))
+
+        if timer is None:
+            timer = StageTimer()
+        self.timer = timer
+        self.hadron_kwargs = hadron_kwargs
+        self.engines = {}
+        self.model_counters = {model: {"parents": 0, "interactions": 0}
+                               for model in self.models}
+
+    @classmethod
+    def crossover(cls, energy, low_model="DpmjetIII191", high_model="Sibyll23d", **kwargs):
+        """`low_model` below `energy` and `high_model` above it
+        """
+        return cls([(low_model, None, energy), (high_model, energy, None)], **kwargs)
+
+    def _check_band(self, band):
+        if len(band) == 3:
+            band = (*band, None)
+        if len(band) != 4:
+            raise ValueError("Band should be (model, min_energy, max_energy[, pdgs]), "
+                             f"got {band}")
+        model, min_energy, max_energy, pdgs = band
+        if not isinstance(model, str):
+            self._model_classes[model.__name__] = model
+            model = model.__name__
+        min_energy = -np.inf if min_energy is None else float(min_energy)
+        max_energy = np.inf if max_energy is None else float(max_energy)
+        if pdgs is not None:
+            pdgs = np.asarray(pdgs, dtype=np.int32)
+        return model, min_energy, max_energy, pdgs
+
+    def engine(self, model):
+        """HadronInteraction of `model`, created at the first call
+        """
+        engine = self.engines.get(model)
+        if engine is None:
+            engine = HadronInteraction(seed=self._model_seeds[model],
+                                       timer=self.timer,
+                                       model=self._model_classes.get(model, model),
+                                       **self.hadron_kwargs)
+            self.engines[model] = engine
+        return engine
+
+    def get_random_state(self):
+        """Random states of initialized models (json serializable dict)
+        """
+        return {model: engine.get_random_state()
+                for model, engine in self.engines.items()}
+
+    def set_random_state(self, random_state):
+        for model, state in random_state.items():
+            self.engine(model).set_random_state(state)
+
+    def route(self, pid, energy):
+        """Index of band in `models` for every parent, -1 if no band
+        """
+        model_index = np.full(len(pid), -1, dtype=np.int32)
+        # The first band wins, so bands are applied in reverse order
+        for model, min_energy, max_energy, pdgs in reversed(self.bands):
+            in_band = np.logical_and(energy >= min_energy, energy < max_energy)
+            if pdgs is not None:
+                in_band &= np.isin(pid, pdgs)
+            model_index[in_band] = self.models.index(model)
+        return model_index
+
+    def run_event_generator(self, parents, children, failed_parents=None):
+        """Run model of every valid particle of `parents`
+        and append secondaries to `children`, see HadronInteraction.run_event_generator
+        """
+        pvalid = parents.valid()
+        pvalid.production_code[:] = 0
+        status = np.full(len(pvalid), EngineStatus.REJECTED.value, dtype=np.int8)
+        parent_rows = []
+        number_of_interactions = 0
+
+        model_index = self.route(pvalid.pid, pvalid.energy)
+        pvalid.production_code[model_index < 0] = 111
+        for index, model in enumerate(self.models):
+            rows = np.flatnonzero(model_index == index)
+            if len(rows) == 0:
+                continue
+
+            with self.timer.stage(f"hadron_interaction.{model}", len(rows)):
+                result = self.engine(model).run_event_generator(pvalid[rows], children)
+            status[rows] = result.status
+            parent_rows.append(rows[result.parent_rows])
+            number_of_interactions += result.number_of_events
+            self.model_counters[model]["parents"] += len(rows)
+            self.model_counters[model]["interactions"] += result.number_of_events
+
+        if failed_parents is not None:
+            failed_parents.append(pvalid[np.where(status == EngineStatus.REJECTED.value)[0]])
+
+        if len(parent_rows) > 0:
+            parent_rows = np.concatenate(parent_rows)
+        else:
+            parent_rows = np.empty(0, dtype=np.int64)
+        return EngineResult(status, parent_rows, number_of_interactions)
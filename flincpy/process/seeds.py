@@ -0,0 +1,13 @@
+import numpy as np
+
+
+def generator_seed(seed):
+    """Integer seed (1 <= seed <= 900000000) for Pythia and chromo models
+    from int, np.random.SeedSequence or None (random seed)
+    
+    900000000 is the largest seed accepted by Pythia
+    """
+    seed_sequence = seed
+    if not isinstance(seed, np.random.SeedSequence):
+        seed_sequence = np.random.SeedSequence(seed)
+    return int(seed_sequence.generate_state(1)[0] % 900000000) + 1
@@ -0,0 +1,98 @@
+import numpy as np
+from data_structs.particle_array import ParticleGroups
+
+
+class HillasThinning:
+    """Hillas thinning of secondary particles
+    
+    Secondaries of one parent (particles with the same `parent_id`) are 
+    thinned if their energy is below the thinning energy `e_thin`:
+    
+    - if the sum of their energies is below `e_thin` 
+      (the parent is already below the thinning level), only one of them 
+      is kept, chosen with probability E_i/sum(E), and its weight 
+      is multiplied by sum(E)/E_i;
+    - otherwise every secondary with E_i < e_thin is kept with 
+      probability E_i/e_thin and its weight is multiplied by e_thin/E_i.
+    
+    Each particle keeps its weighted contribution on average, so 
+    weighted histograms are unbiased, while the number of tracked 
+    particles scales with E_primary/e_thin.
+    """
+    # Columns of ParticleArray used by thinning
+    required_columns = ["energy",
+                        "parent_id",
+                        "weight"]
+    
+    def __init__(self, rng=None):
+        self.set_rng(rng)
+        
+    def set_rng(self, rng):
+        """Set np.random.Generator (or seed for it) used for sampling
+        """
+        self.rng = np.random.default_rng(rng)
+    
+    def thin(self, pstack, e_thin, parent_rows=None):
+        """Thin valid particles of `pstack` in place
+        
+        Args:
+            pstack (ParticleArray): secondaries
+            e_thin (float or np.array): thinning energy, 
+                scalar or value for every particle
+            parent_rows (np.array): parent of every particle
+                (EngineResult.parent_rows), `parent_id` is used if None
+        
+        Returns:
+            int: number of removed particles
+        """
+        pvalid = pstack.valid()
+        nparticles = len(pvalid)
+        if nparticles == 0:
+            return 0
+        
+        energy = pvalid.energy.astype(np.float64)
+        e_thin = np.broadcast_to(np.asarray(e_thin, dtype=np.float64), (nparticles,))
+        
+        if parent_rows is None:
+            groups = pvalid.group_by("parent_id")
+        else:
+            groups = ParticleGroups(parent_rows)
+        energy_sorted = groups.sort(energy)
+        starts = groups.offsets[:-1]
+        group_energy = np.add.reduceat(energy_sorted, starts)
+        group_size = np.diff(groups.offsets)
+        energy_sum = groups.unsort(np.repeat(group_energy, group_size))
+        
+        keep = np.ones(nparticles, dtype=bool)
+        factor = np.ones(nparticles, dtype=np.float64)
+        
+        # Parents below thinning level: keep one secondary per parent
+        below = energy_sum < e_thin
+        if np.any(below):
+            # Choose one secondary by the cumulative energy within the parent
+            cumulative = np.cumsum(energy_sorted)
+            group_start = cumulative[starts] - energy_sorted[starts]
+            target = group_start + self.rng.random(len(starts)) * group_energy
+            chosen = np.searchsorted(cumulative, target, side="right")
+            chosen = np.minimum(chosen, groups.offsets[1:] - 1)
+            
+            is_chosen_sorted = np.zeros(nparticles, dtype=bool)
+            is_chosen_sorted[chosen] = True
+            is_chosen = groups.unsort(is_chosen_sorted)
+            
+            keep[below] = is_chosen[below]
+            chosen_below = np.logical_and(below, is_chosen)
+            factor[chosen_below] = np.divide(energy_sum[chosen_below], energy[chosen_below],
+                                             out=np.ones(np.count_nonzero(chosen_below)),
+                                             where=energy[chosen_below] > 0)
+        
+        # Other secondaries below thinning energy: keep with E_i/e_thin
+        thinned = np.logical_and(np.logical_not(below), energy < e_thin)
+        if np.any(thinned):
+            probability = energy[thinned] / e_thin[thinned]
+            keep[thinned] = self.rng.random(len(probability)) < probability
+            factor[thinned] = 1 / probability
+        
+        pvalid.weight[:] = pvalid.weight * factor
+        pstack.keep(keep)
+        return nparticles - int(np.count_nonzero(keep))
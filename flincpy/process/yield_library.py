@@ -0,0 +1,221 @@
+import json
+import numpy as np
+from pathlib import Path
+
+from process.hadron_inter import HadronInteraction
+from process.engine_result import EngineResult, EngineStatus
+from data_structs.stage_timer import StageTimer
+
+
+# Secondaries are stored with the mass and the kinetic energy as a fraction
+# of the parent energy, so they can be rescaled to any energy near 
+# the grid point without going below the mass
+secondary_dtype = np.dtype([("pid", np.int32), 
+                            ("mass", np.float32),
+                            ("kinetic_fraction", np.float32)])
+
+
+def build_yield_library(path, pdgs, energy_grid, events_per_point,
+                        hadron_interaction=None, seed=None):
+    """Generate library of events for TabulatedHadronInteraction
+
+    For every projectile in `pdgs` and energy in `energy_grid`
+    `events_per_point` events are generated with `hadron_interaction`
+    (HadronInteraction with DPMJET by default). Files in directory `path`:
+    "secondaries.bin" - secondaries of all events (`secondary_dtype`),
+    "offsets.npy" - start of every event in secondaries (one more element
+    for the end of the last event), events are ordered by
+    (projectile, energy, event), "meta.json" - grids and sizes.
+
+    Points which can't be generated (projectile is not allowed,
+    too low energy) get no events and are not sampled.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    if hadron_interaction is None:
+        hadron_interaction = HadronInteraction(seed=seed)
+
+    pdgs = [int(pdg) for pdg in pdgs]
+    energy_grid = np.asarray(energy_grid, dtype=np.float64)
+    offsets = np.zeros(len(pdgs) * len(energy_grid) * events_per_point + 1, dtype=np.int64)
+    valid_points = np.zeros((len(pdgs), len(energy_grid)), dtype=bool)
+
+    nsecondaries = 0
+    ievent = 0
+    with open(path / "secondaries.bin", "wb") as secondaries_file:
+        for pdg in pdgs:
+            for energy in energy_grid:
+                code = hadron_interaction.set_kinematics(pdg, energy)
+                if code > 0:
+                    offsets[ievent + 1: ievent + events_per_point + 1] = nsecondaries
+                    ievent += events_per_point
+                    continue
+
+                valid_points[pdgs.index(pdg), np.searchsorted(energy_grid, energy)] = True
+                for event in hadron_interaction.event_generator(events_per_point):
+                    event = event.final_state()
+                    secondaries = np.empty(len(event.pid), dtype=secondary_dtype)
+                    secondaries["pid"] = event.pid
+                    secondaries["mass"] = event.m
+                    secondaries["kinetic_fraction"] = (event.en - event.m) / energy
+                    secondaries.tofile(secondaries_file)
+                    nsecondaries += len(secondaries)
+                    ievent += 1
+                    offsets[ievent] = nsecondaries
+
+    np.save(path / "offsets.npy", offsets)
+    meta = {"pdgs": pdgs,
+            "energy_grid": energy_grid.tolist(),
+            "events_per_point": events_per_point,
+            "valid_points": valid_points.tolist(),
+            "nsecondaries": nsecondaries}
+    with open(path / "meta.json", "w") as meta_file:
+        json.dump(meta, meta_file)
+
+
+class TabulatedHadronInteraction:
+    """Hadron interactions sampled from a library of pre-generated events
+
+    The library is built once with `build_yield_library` and is memory mapped,
+    so only sampled events are read. Parents with projectile and energy
+    covered by the library (and energy <= `max_energy`) get secondaries of
+    a random library event at one of the two nearest grid energies
+    (chosen randomly with weights by log distance), with kinetic energies 
+    rescaled to the parent energy. Other parents are passed to `fallback`
+    (HadronInteraction), or rejected if there is no fallback.
+
+    The interface is the same as of HadronInteraction.
+    """
+    required_columns = HadronInteraction.required_columns
+
+    def __init__(self, library_path, max_energy=None, fallback=None,
+                 seed=None, timer=None):
+        """
+        Args:
+            library_path (str or Path): directory made by `build_yield_library`
+            max_energy (float): parents above it go to fallback,
+                the end of energy grid if None
+            fallback (HadronInteraction): engine for parents not covered
+                by the library
+            seed (int or np.random.SeedSequence): seed of sampling
+            timer (StageTimer): collects time of sampling
+        """
+        library_path = Path(library_path)
+        with open(library_path / "meta.json") as meta_file:
+            meta = json.load(meta_file)
+
+        self.pdgs = np.array(meta["pdgs"], dtype=np.int32)
+        self.energy_grid = np.array(meta["energy_grid"], dtype=np.float64)
+        self.events_per_point = meta["events_per_point"]
+        self.valid_points = np.array(meta["valid_points"], dtype=bool)
+        self.offsets = np.load(library_path / "offsets.npy", mmap_mode="r")
+        self.secondaries = np.memmap(library_path / "secondaries.bin",
+                                     dtype=secondary_dtype, mode="r",
+                                     shape=(meta["nsecondaries"],))
+
+        self.max_energy = self.energy_grid[-1] if max_energy is None else max_energy
+        self.fallback = fallback
+        if timer is None:
+            timer = StageTimer()
+        self.timer = timer
+        self.set_rng(np.random.default_rng(seed))
+
+        # Projectile index for pdgs, -1 if not in library
+        self._pdg_sorter = np.argsort(self.pdgs)
+
+    def set_rng(self, rng):
+        self.rng = np.random.default_rng(rng)
+
+    def get_random_state(self):
+        state = {"library": self.rng.bit_generator.state}
+        if self.fallback is not None:
+            state["fallback"] = self.fallback.get_random_state()
+        return state
+
+    def set_random_state(self, random_state):
+        self.rng.bit_generator.state = random_state["library"]
+        if self.fallback is not None:
+            self.fallback.set_random_state(random_state["fallback"])
+
+    def _projectile_index(self, pid):
+        index = np.searchsorted(self.pdgs, pid, sorter=self._pdg_sorter)
+        index = np.minimum(index, len(self.pdgs) - 1)
+        projectile = self._pdg_sorter[index]
+        return np.where(self.pdgs[projectile] == pid, projectile, -1)
+
+    def _grid_index(self, energy):
+        """Stochastic nearest grid point in log energy
+        """
+        if len(self.energy_grid) == 1:
+            return np.zeros(len(energy), dtype=np.int64)
+        log_grid = np.log(self.energy_grid)
+        upper = np.clip(np.searchsorted(log_grid, np.log(energy)), 1, len(log_grid) - 1)
+        lower = upper - 1
+        # Probability to take the upper point grows linearly in log energy
+        upper_weight = (np.log(energy) - log_grid[lower]) / (log_grid[upper] - log_grid[lower])
+        take_upper = self.rng.random(len(energy)) < upper_weight
+        return np.where(take_upper, upper, lower)
+
+    def run_event_generator(self, parents, children, failed_parents=None):
+        """Sample secondaries for valid particles of `parents`
+        and append them to `children`, see HadronInteraction.run_event_generator
+        """
+        pvalid = parents.valid()
+        pvalid.production_code[:] = 0
+        nparents = len(pvalid)
+        status = np.full(nparents, EngineStatus.PROCESSED.value, dtype=np.int8)
+
+        start_time = self.timer.start()
+        projectile = self._projectile_index(pvalid.pid)
+        in_library = np.logical_and.reduce([projectile >= 0,
+                                            pvalid.energy >= self.energy_grid[0],
+                                            pvalid.energy <= self.max_energy])
+        rows = np.flatnonzero(in_library)
+        grid_index = self._grid_index(pvalid.energy[rows])
+        # Only points with generated events
+        has_events = self.valid_points[projectile[rows], grid_index]
+        in_library[rows[~has_events]] = False
+        rows = rows[has_events]
+        grid_index = grid_index[has_events]
+
+        event_index = ((projectile[rows] * len(self.energy_grid) + grid_index)
+                       * self.events_per_point
+                       + self.rng.integers(self.events_per_point, size=len(rows)))
+        starts = np.asarray(self.offsets[event_index])
+        counts = np.asarray(self.offsets[event_index + 1]) - starts
+
+        # Indices of secondaries of all sampled events
+        child_parent = np.repeat(np.arange(len(rows)), counts)
+        first_child = np.cumsum(counts) - counts
+        secondary_index = (np.repeat(starts, counts)
+                           + np.arange(len(child_parent)) - first_child[child_parent])
+        secondaries = self.secondaries[secondary_index]
+        parent_rows = rows[child_parent]
+
+        children.push(pid = secondaries["pid"],
+                      energy = (secondaries["mass"] 
+                                + secondaries["kinetic_fraction"] * pvalid.energy[parent_rows]),
+                      xdepth = pvalid.xdepth_inter[parent_rows],
+                      generation_num = pvalid.generation_num[parent_rows] + 1,
+                      parent_id = pvalid.id[parent_rows],
+                      shower_id = pvalid.shower_id[parent_rows],
+                      weight = pvalid.weight[parent_rows],
+                      production_code = np.full(len(parent_rows), 777, dtype=np.int32))
+        self.timer.stop("hadron_interaction.yield_library", start_time, particles=len(rows))
+        number_of_interactions = len(rows)
+
+        others = np.flatnonzero(~in_library)
+        if len(others) > 0:
+            if self.fallback is not None:
+                result = self.fallback.run_event_generator(pvalid[others], children)
+                number_of_interactions += result.number_of_events
+                status[others] = result.status
+                parent_rows = np.concatenate([parent_rows, others[result.parent_rows]])
+            else:
+                pvalid.production_code[others] = 111
+                status[others] = EngineStatus.REJECTED.value
+
+        if failed_parents is not None:
+            failed_parents.append(pvalid[np.where(status == EngineStatus.REJECTED.value)[0]])
+
+        return EngineResult(status, parent_rows.astype(np.int64), number_of_interactions)
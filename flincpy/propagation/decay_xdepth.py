@@ -8,9 +8,16 @@ import numpy as np
 class DecayXdepth:
     def __init__(self, *,
                  tab_particle_properties = TabulatedParticleProperties(),
-                 xdepth_on_table = XdepthOnTable()):
+                 xdepth_on_table = XdepthOnTable(),
+                 rng = None):
         self.pp_tab = tab_particle_properties
         self.xd_tab = xdepth_on_table
+        self.set_rng(rng)
+    
+    def set_rng(self, rng):
+        """Set np.random.Generator (or seed for it) used for sampling
+        """
+        self.rng = np.random.default_rng(rng)
 
     def get_xdepth(self, pdg, energy, xdepth):
         mass = self.pp_tab.mass(pdg)
@@ -18,7 +25,7 @@ class DecayXdepth:
             energy, mass, out=np.full_like(mass, np.inf), where=mass != 0
         )
         bgamma = np.sqrt((gamma + 1) * (gamma - 1))
-        rnd = -np.log(1 - np.random.rand(len(pdg)))
+        rnd = self.rng.standard_exponential(len(pdg))
         length = rnd * bgamma * self.pp_tab.ctau(pdg)
         
         # print(f"length = {length/1e5} km")
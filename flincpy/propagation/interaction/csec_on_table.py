@@ -1,9 +1,10 @@
 import numpy as np
 from data_structs.pdg_pid_map import PdgPidMap
+from data_structs.particle_array import ParticleGroups
 
                           
 class CrossSectionOnTable:
-    def __init__(self, cross_section_table):
+    def __init__(self, cross_section_table, rng=None):
         # Cross section table
         self.sigma_tab = cross_section_table.get_sigma()
         # Xdepth table
@@ -12,55 +13,68 @@ class CrossSectionOnTable:
         self.energy_grid = cross_section_table.get_energy_grid()
         # Pdg to pid maps
         self.pmap = PdgPidMap(cross_section_table.get_pid_pdg_dict())
+        self.set_rng(rng)
     
-    def get_cross_section(self, pdg, energy, sigma):
+    def set_rng(self, rng):
+        """Set np.random.Generator (or seed for it) used for sampling
+        """
+        self.rng = np.random.default_rng(rng)
+    
+    def get_cross_section(self, pdg, energy, sigma, groups=None):
         """Fills sigma array with cross section for particles with pdg and energy
 
         Args:
             pdg (np.array): array of pdgs
             energy (np.array): array of energies
             sigma (np.array): output array with cross section
+            groups (ParticleGroups): particles grouped by pdg, 
+                computed if not given
         """
-        pid_array = self.pmap.get_pids(pdg)
-        for pid in set(pid_array):
-            pid_slice = np.where(pid_array == pid)[0]
-            sigma[pid_slice] = np.interp(energy[pid_slice], self.energy_grid, self.sigma_tab[pid,:])
+        if groups is None:
+            groups = ParticleGroups(pdg)
+        
+        pid_keys = self.pmap.get_pids(groups.keys)
+        energy_sorted = groups.sort(energy)
+        sigma_sorted = np.empty(len(pdg), dtype=np.float64)
+        for pid, segment in zip(pid_keys, groups.segments()):
+            sigma_sorted[segment] = np.interp(energy_sorted[segment], self.energy_grid, self.sigma_tab[pid,:])
+        sigma[:] = groups.unsort(sigma_sorted)
             
-    def get_mean_xdepth(self, pdg, energy):
+    def get_mean_xdepth(self, pdg, energy, groups=None):
         """Get xdepth array with mean xdepth for particles with pdg and energy
 
         Args:
             pdg (np.array): array of pdgs
             energy (np.array): array of energies
-            xdepth (np.array): output array with xdepth
+            groups (ParticleGroups): particles grouped by pdg, 
+                computed if not given
         """
-        xdepth = np.empty(len(pdg), dtype=np.float64)
-        pid_array = self.pmap.get_pids(pdg)
-        # print(f"pid_slice = {pid_array}")
-        # print(f"pid_pdg = {self.pmap.pid_pdg}")
-        # print(f"pdg_pid = {self.pmap.pdg_pid}")
-        # print(f"pid_pdg_dict = {self.pmap.pid_pdg_dict}")
-        for pid in set(pid_array):
-            pid_slice = np.where(pid_array == pid)[0]
-            # print(f"pid_slice = {pid_slice}")
+        if groups is None:
+            groups = ParticleGroups(pdg)
+            
+        pid_keys = self.pmap.get_pids(groups.keys)
+        energy_sorted = groups.sort(energy)
+        xdepth_sorted = np.empty(len(pdg), dtype=np.float64)
+        for pid, segment in zip(pid_keys, groups.segments()):
             if abs(pid) > self.pmap.max_pid:
-                xdepth[pid_slice] = np.full_like(energy[pid_slice], np.inf, dtype=np.float64)
+                xdepth_sorted[segment] = np.inf
             else:
-                xdepth[pid_slice] = np.interp(energy[pid_slice], self.energy_grid, self.xdepth_tab[pid,:])
+                xdepth_sorted[segment] = np.interp(energy_sorted[segment], self.energy_grid, self.xdepth_tab[pid,:])
                     
-        return xdepth
+        return groups.unsort(xdepth_sorted)
             
-    def get_xdepth(self, pdg, energy):
+    def get_xdepth(self, pdg, energy, groups=None):
         """Return xdepth array with (random) xdepth for next interaction 
         for particles with pdg and energy
 
         Args:
             pdg (np.array): array of pdgs
             energy (np.array): array of energies
-            xdepth (np.array): output array with xdepth
+            groups (ParticleGroups): particles grouped by pdg, 
+                computed if not given
         """
-        mean_xdepth = self.get_mean_xdepth(pdg, energy)        
-        rnd = -np.log(1 - np.random.rand(len(pdg)))
+        mean_xdepth = self.get_mean_xdepth(pdg, energy, groups)        
+        rnd = self.rng.standard_exponential(len(pdg))
         return mean_xdepth * rnd  
                  
 
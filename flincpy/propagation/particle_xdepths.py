@@ -22,6 +22,9 @@ class NextDecayXdepth:
     
     def set_stop_xdepth(self, stop_xdepth):
         self._stop_xdepth = stop_xdepth        
+    
+    def set_rng(self, rng):
+        self.decay_xdepth.set_rng(rng)
          
     def get_xdepth(self, pstack):
         """Set xdepth_decay and filter_code for pstack[0:len(pstack)]
@@ -54,16 +57,23 @@ class NextInterXdepth:
     
     def set_stop_xdepth(self, stop_xdepth):
         self._stop_xdepth = stop_xdepth    
+    
+    def set_rng(self, rng):
+        self.inter_xdepth.set_rng(rng)
          
-    def get_xdepth(self, pstack):
+    def get_xdepth(self, pstack, groups=None):
         """Set xdepth_inter for pstack[0:len(pstack)]
         
-        Make sure that pstack._len is correct
+        Make sure that pstack._len is correct. 
+        `groups` is pstack.group_by("pid"), computed if not given
         """       
         pvalid = pstack.valid()
+        if groups is None:
+            groups = pvalid.group_by("pid")
         result_with_infs = (self.inter_xdepth
                             .get_xdepth(pdg = pvalid.pid, 
-                                        energy = pvalid.energy) + pvalid.xdepth)
+                                        energy = pvalid.energy,
+                                        groups = groups) + pvalid.xdepth)
         
         # pstack.xdepth_decay[np.where(result_with_infs >= self.max_xdepth)] = np.inf
         
@@ -77,7 +87,15 @@ class NextInterXdepth:
         
 
 class DefaultXdepthGetter:
-    def __init__(self, theta_deg = 0, mode="both"):
+    # Columns of ParticleArray used by xdepth getters
+    required_columns = ["pid",
+                        "energy",
+                        "xdepth",
+                        "xdepth_decay",
+                        "xdepth_inter",
+                        "filter_code"]
+    
+    def __init__(self, theta_deg = 0, mode="both", rng=None):
         self.atmosphere = CorsikaAtmosphere("USStd", None)
         self.xdepth_conversion =  XdepthConversion(atmosphere = self.atmosphere)
         self.xdepth_conversion.set_theta(theta_deg)
@@ -93,18 +111,31 @@ class DefaultXdepthGetter:
             self.next_inter = NextInterXdepth(xdepth_on_table=self.xdepth_on_table)
         else:
             raise ValueError("this should not happen")    
+        
+        self.set_rng(rng)
                 
     
     def set_stop_xdepth(self, stop_xdepth):
         self.next_decay.set_stop_xdepth(stop_xdepth)
         self.next_inter.set_stop_xdepth(stop_xdepth)
+    
+    def set_rng(self, rng):
+        """Set np.random.Generator (or seed for it) for decay and interaction
+        depths. Decay and interaction samplers get independent streams 
+        spawned from it.
+        """
+        decay_rng, inter_rng = np.random.default_rng(rng).spawn(2)
+        if hasattr(self, "next_decay"):
+            self.next_decay.set_rng(decay_rng)
+        if hasattr(self, "next_inter"):
+            self.next_inter.set_rng(inter_rng)
                     
     
     def get_decay_xdepth(self, pstack):
         return self.next_decay.get_xdepth(pstack)
     
-    def get_inter_xdepth(self, pstack):
-        return self.next_inter.get_xdepth(pstack)
+    def get_inter_xdepth(self, pstack, groups=None):
+        return self.next_inter.get_xdepth(pstack, groups)
     
 # default_xdepth_getter = DefaultXdepthGetter(mode="decay")
 # default_xdepth_getter = DefaultXdepthGetter()